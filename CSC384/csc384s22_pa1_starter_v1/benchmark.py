@@ -0,0 +1,327 @@
+'''Benchmarks: how build and solve times grow with the size of the problem.
+
+Each case builds one model of one size and solves it once with bt_search
+and one propagator. The suites are
+
+    queens      n-Queens (binary table constraints), n in QUEENS_SIZES
+    warehouse   generated warehouse boards, n in WAREHOUSE_SIZES, with
+                each of the three model builders of models.py
+
+and for every case the benchmark records the time to build the model,
+the time to solve it, the decisions and prunings of the search and the
+peak memory (bytes allocated by Python, measured with tracemalloc in a
+separate run, in a process of its own, so that tracing does not slow
+down the timed runs and earlier cases do not change it), e.g.,
+
+    results = run_benchmarks()
+    save_results(results, "bench.json")
+    for problem in compare(results, load_results("baseline.json")):
+        print(problem)
+
+or from the command line
+
+    python benchmark.py --out bench.json --baseline baseline.json
+
+which exits with status 1 if a case is slower, uses more memory or
+searches more than in the baseline.
+
+The baseline of the repository is benchmark_baseline.json, next to this
+file; --baseline with no file name compares against it. Its decisions
+and prunings hold on any machine, but its times and memory are those of
+the machine it was made on, so before comparing times on another
+machine, make a baseline there from a known good commit with
+
+    python benchmark.py --save-baseline
+
+and commit it again (with the change) whenever a change is meant to
+alter the search, i.e., the decisions or prunings of some case.
+
+The generated warehouse boards only depend on the size and the seed, so
+the decisions and prunings of a case are the same from run to run
+unless the search itself changes. Every solve is stopped after
+'timeout' seconds (see Limits); the case is then recorded with status
+"limit".
+'''
+import argparse
+import contextlib
+import functools
+import gc
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from cspbase import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from propagators import prop_BT, prop_FC, prop_GAC
+from models import warehouse_binary_ne_grid, warehouse_nary_ad_grid, warehouse_full_model
+
+QUEENS_SIZES = [4, 6, 8, 10, 12]
+WAREHOUSE_SIZES = [3, 4, 5, 6]
+PROPAGATORS = [prop_BT, prop_FC, prop_GAC]
+MODELS = [warehouse_binary_ne_grid, warehouse_nary_ad_grid, warehouse_full_model]
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+#what compare checks: key --> a case is a regression if new > old * (1 + tolerance)
+TIMED = ["build_time", "solve_time"]
+COUNTED = ["decisions", "prunings"]
+
+def queens_model(n):
+    '''Return an n-Queens CSP, one variable per row, the same model as
+       nQueens in propagators_test.py'''
+    dom = list(range(1, n + 1))
+    vars = [Variable('Q{}'.format(i), dom) for i in dom]
+    csp = CSP("{}-Queens".format(n), vars)
+    for qi, qj in itertools.combinations(range(n), 2):
+        sat_tuples = [t for t in itertools.product(dom, dom)
+                      if t[0] != t[1] and abs(t[0] - t[1]) != qj - qi]
+        c = Constraint("C(Q{},Q{})".format(qi + 1, qj + 1), [vars[qi], vars[qj]])
+        c.set_table(TupleTable.intern(TupleTable([dom, dom], sat_tuples)))
+        csp.add_constraint(c)
+    return csp, [vars]
+
+def random_warehouse(n, seed=0, max_rooms=4):
+    '''Return a warehouse board of size n (n <= 9) that has a solution.
+
+       A random Latin square is split into random connected buildings of
+       1 to max_rooms rooms; a building of one room gets operation 0,
+       the others a random one of sum (1), min (2) and max (3), with the
+       target taken from the Latin square.'''
+    rng = random.Random("{}/{}".format(n, seed))
+    rows = list(range(n))
+    cols = list(range(n))
+    vals = list(range(1, n + 1))
+    rng.shuffle(rows)
+    rng.shuffle(cols)
+    rng.shuffle(vals)
+    square = [[vals[(rows[i] + cols[j]) % n] for j in range(n)] for i in range(n)]
+
+    cells = [(col, row) for col in range(1, n + 1) for row in range(1, n + 1)]
+    rng.shuffle(cells)
+    free = set(cells)
+    board = [[n]]
+    for cell in cells:
+        if cell not in free:
+            continue
+        free.discard(cell)
+        rooms = [cell]
+        size = rng.randint(1, max_rooms)
+        while len(rooms) < size:
+            col, row = rng.choice(rooms)
+            nbrs = [c for c in [(col + 1, row), (col - 1, row), (col, row + 1), (col, row - 1)]
+                    if c in free]
+            if not nbrs:
+                break
+            nbr = rng.choice(nbrs)
+            free.discard(nbr)
+            rooms.append(nbr)
+        #room (col, row) is var_array[n - row][col - 1] in models.py
+        values = [square[n - row][col - 1] for col, row in rooms]
+        if len(rooms) == 1:
+            op, target = 0, values[0]
+        else:
+            op = rng.randint(1, 3)
+            target = [None, sum, min, max][op](values)
+        board.append([col * 10 + row for col, row in rooms] + [op, target])
+    return board
+
+def cases(suites=("queens", "warehouse"), propagators=None, queens_sizes=None,
+          warehouse_sizes=None, models=None, seed=0):
+    '''Generate the cases (suite, model name, size, build, propagator),
+       where build() returns (csp, var_array)'''
+    propagators = PROPAGATORS if propagators is None else propagators
+    if "queens" in suites:
+        for n in QUEENS_SIZES if queens_sizes is None else queens_sizes:
+            for prop in propagators:
+                yield "queens", "queens", n, functools.partial(queens_model, n), prop
+    if "warehouse" in suites:
+        for n in WAREHOUSE_SIZES if warehouse_sizes is None else warehouse_sizes:
+            board = random_warehouse(n, seed)
+            for model in MODELS if models is None else models:
+                for prop in propagators:
+                    yield "warehouse", model.__name__, n, functools.partial(model, board), prop
+
+def run_case(build, propagator, repeat=1, timeout=None, memory=True):
+    '''Build and solve one case repeat times (best times are kept) and
+       return its results as a dict. A case stopped by the timeout is
+       not repeated.'''
+    result = dict()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        csp, _ = build()
+        build_time = time.perf_counter() - start
+        limits = None if timeout is None else Limits(wall=timeout)
+        with contextlib.redirect_stdout(io.StringIO()):
+            status, stats, _ = BT(csp).bt_search(propagator, limits=limits)
+        if "build_time" not in result or build_time < result["build_time"]:
+            result["build_time"] = build_time
+        if "solve_time" not in result or stats["time"]["wall"] < result["solve_time"]:
+            result["solve_time"] = stats["time"]["wall"]
+        result["status"] = status
+        result["decisions"] = stats["nodes"]
+        result["prunings"] = stats["prunings"]
+        result["failures"] = stats["failures"]
+        if status == LIMIT:
+            break
+    if memory:
+        #the same search again, stopped after as many decisions
+        limits = Limits(decisions=result["decisions"]) if status == LIMIT else None
+        result["peak_memory"] = peak_memory(build, propagator, limits)
+    return result
+
+def peak_memory(build, propagator, limits=None):
+    '''Peak bytes allocated by Python while building and solving a case.
+
+       The case is run in a new process: what it allocates depends on
+       what ran before it in the same process (tables still interned,
+       support masks already cached), so the same case would measure
+       differently depending on which cases ran first.'''
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(traced_peak, (build, propagator, limits))
+
+def traced_peak(build, propagator, limits=None):
+    '''Internal routine. peak_memory in the current process, after a
+       first untraced run of the case so that what is only done once
+       per process (e.g., numpy importing its submodules) is not
+       counted'''
+    csp, _ = build()
+    with contextlib.redirect_stdout(io.StringIO()):
+        BT(csp).bt_search(propagator, limits=limits)
+    del csp
+    gc.collect()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    try:
+        csp, _ = build()
+        with contextlib.redirect_stdout(io.StringIO()):
+            BT(csp).bt_search(propagator, limits=limits)
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+def run_benchmarks(repeat=3, timeout=10, memory=True, verbose=False, **kwargs):
+    '''Run the cases (kwargs are passed to cases) and return the results:
+       {"meta": ..., "results": [one dict per case]}'''
+    results = []
+    for suite, model, n, build, prop in cases(**kwargs):
+        res = {"case": "{}/{}/{}".format(model, prop.__name__, n),
+               "suite": suite, "model": model, "propagator": prop.__name__, "size": n}
+        res.update(run_case(build, prop, repeat, timeout, memory))
+        results.append(res)
+        if verbose:
+            print("{:45} {:6} build {:8.4f}s solve {:8.4f}s {:8} decisions".format(
+                res["case"], res["status"], res["build_time"], res["solve_time"],
+                res["decisions"]), file=sys.stderr)
+    meta = {"python": platform.python_version(), "numpy": numpy is not None,
+            "repeat": repeat, "timeout": timeout}
+    return {"meta": meta, "results": results}
+
+def scaling_curves(results):
+    '''Return {(model, propagator): [(size, build_time, solve_time), ...]}'''
+    curves = dict()
+    for res in results["results"]:
+        curves.setdefault((res["model"], res["propagator"]), []).append(
+            (res["size"], res["build_time"], res["solve_time"]))
+    for curve in curves.values():
+        curve.sort()
+    return curves
+
+def print_curves(results):
+    for (model, prop), curve in scaling_curves(results).items():
+        print("{} with {}".format(model, prop))
+        print("  {:>4} {:>10} {:>10}".format("n", "build", "solve"))
+        for n, build_time, solve_time in curve:
+            print("  {:4} {:10.4f} {:10.4f}".format(n, build_time, solve_time))
+
+def compare(results, baseline, tolerance=0.25, min_time=0.05):
+    '''Return a list of the regressions of results with respect to
+       baseline, one message per regression.
+
+       A case regresses if it is more than tolerance (a fraction) slower
+       to build or solve, or uses more than tolerance more peak memory,
+       than in the baseline. Times under min_time seconds are too noisy
+       and are not compared. The search is deterministic, so any change
+       in the decisions or prunings of a case is reported, as is a case
+       that is no longer solved.'''
+    old = dict([(res["case"], res) for res in baseline["results"]])
+    problems = []
+    for res in results["results"]:
+        base = old.get(res["case"])
+        if base is None:
+            continue
+        case = res["case"]
+        if res["status"] != base["status"]:
+            problems.append("{}: status {} (was {})".format(case, res["status"], base["status"]))
+        if res["status"] == LIMIT or base["status"] == LIMIT:
+            #a stopped search is only timed
+            continue
+        for key in TIMED:
+            if res[key] > max(base[key], min_time) * (1 + tolerance):
+                problems.append("{}: {} {:.4f}s (was {:.4f}s)".format(case, key, res[key], base[key]))
+        if "peak_memory" in res and "peak_memory" in base:
+            if res["peak_memory"] > base["peak_memory"] * (1 + tolerance):
+                problems.append("{}: peak_memory {} bytes (was {})".format(
+                    case, res["peak_memory"], base["peak_memory"]))
+        for key in COUNTED:
+            if res[key] != base[key]:
+                problems.append("{}: {} {} (was {})".format(case, key, res[key], base[key]))
+    return problems
+
+def save_results(results, fname):
+    with open(fname, "w") as f:
+        json.dump(results, f, indent=1)
+
+def load_results(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CSP propagators and models")
+    parser.add_argument("--out", help="save the results to this JSON file")
+    parser.add_argument("--baseline", nargs="?", const=BASELINE,
+                        help="compare with the results in this JSON file "
+                             "(default: benchmark_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save the results as benchmark_baseline.json")
+    parser.add_argument("--suite", action="append", choices=["queens", "warehouse"],
+                        help="suite to run (default: all)")
+    parser.add_argument("--queens", type=int, nargs="+", help="n-Queens sizes")
+    parser.add_argument("--warehouse", type=int, nargs="+", help="warehouse sizes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--no-memory", action="store_true", help="do not measure peak memory")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat, args.timeout, not args.no_memory, True,
+                             suites=args.suite or ("queens", "warehouse"),
+                             queens_sizes=args.queens, warehouse_sizes=args.warehouse)
+    print_curves(results)
+    if args.out:
+        save_results(results, args.out)
+    if args.save_baseline:
+        save_results(results, BASELINE)
+    if args.baseline:
+        problems = compare(results, load_results(args.baseline), args.tolerance)
+        for problem in problems:
+            print("REGRESSION", problem)
+        if problems:
+            return 1
+        print("No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,24 @@
 import time
+import random
+import sys
 import functools
+import heapq
+import itertools
+import json
+import bisect
+import weakref
+from array import array
+from collections import deque
+
+try:
+    import resource
+except ImportError:     #not on Windows: Limits(memory=...) is then ignored
+    resource = None
+
+try:
+    import numpy
+except ImportError:     #optional: TupleTable falls back to the array module
+    numpy = None
 
 '''Constraint Satisfaction Routines
    A) class Variable
@@ -11,14 +30,16 @@ import functools
       added but NOT deleted from.
       
       To support constraint propagation, the class also maintains a
-      set of flags to indicate if a value is still in its current domain.
+      bitmask to indicate if a value is still in its current domain.
       So one can remove values, add them back, and query if they are 
       still current. 
 
     B) class constraint
 
       This class allows one to define constraints specified by tables
-      of satisfying assignments.
+      of satisfying assignments. Subclasses (e.g., FunctionConstraint)
+      define the constraint in other ways but are used in the same way
+      by the CSP and the propagators.
 
       On initialization the variables the constraint is over is
       specified (i.e. the scope of the constraint). This must be an
@@ -36,6 +57,12 @@ import functools
 
 '''
 
+def _popcount_bin(mask):
+    return bin(mask).count("1")
+
+#int.bit_count is only available from Python 3.10 on
+popcount = getattr(int, "bit_count", _popcount_bin)
+
 class Variable: 
 
     '''Class for defining CSP variables.  On initialization the
@@ -45,8 +72,10 @@ class Variable:
 
        The variable object offers two types of functionality to support
        search. 
-       (a) It has a current domain, implimented as a set of flags 
-           determining which domain values are "current", i.e., unpruned.
+       (a) It has a current domain, implimented as an integer bitmask
+           (bit i is set iff the i-th domain value is "current", i.e., 
+           unpruned) together with a value --> index map, so membership
+           tests, pruning and restoring are all O(1).
            - you can prune a value, and restore it.
            - you can obtain a list of values in the current domain, or count
              how many are still there
@@ -80,17 +109,24 @@ class Variable:
         string). Optionally specify the initial domain.
         '''
         self.name = name                #text name for variable
-        self.dom = list(domain)         #Make a copy of passed domain
-        self.curdom = [True] * len(domain)      #using list
+        self.dom = []                   #permanent domain, in insertion order
+        self.dom_index = dict()         #value --> position of value in self.dom
+        self.curdom = 0                 #bitmask, bit i set iff self.dom[i] is current
+        self.add_domain_values(domain)
         #for bt_search
         self.assignedValue = None
+        self.trail = None               #Trail recording curdom changes, set by bt_search
+        self.listener = None            #called with self after curdom or assignment changes
+        self.watches = []               #(constraint, position) for each place self is in a scope
 
     def add_domain_values(self, values):
         '''Add additional domain values to the domain
            Removals not supported removals'''
         for val in values: 
+            if not val in self.dom_index:
+                self.dom_index[val] = len(self.dom)
+            self.curdom |= 1 << len(self.dom)
             self.dom.append(val)
-            self.curdom.append(True)
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -106,46 +142,73 @@ class Variable:
 
     def prune_value(self, value):
         '''Remove value from CURRENT domain'''
-        self.curdom[self.value_index(value)] = False
+        trail = self.trail
+        if trail is not None:
+            trail.push(self, self.curdom)
+            trail.prunings = trail.prunings + 1
+        self.curdom &= ~(1 << self.dom_index[value])
+        if self.listener is not None:
+            self.listener(self)
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
-        self.curdom[self.value_index(value)] = True
+        if self.trail is not None:
+            self.trail.push(self, self.curdom)
+        self.curdom |= 1 << self.dom_index[value]
+        if self.listener is not None:
+            self.listener(self)
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
            only assigned value is viewed as being in current domain)'''
-        vals = []
         if self.is_assigned():
-            vals.append(self.get_assigned_value())
-        else:
-            for i, val in enumerate(self.dom):
-                if self.curdom[i]:
-                    vals.append(val)
+            return [self.get_assigned_value()]
+        vals = []
+        mask = self.curdom
+        while mask:
+            low = mask & -mask
+            vals.append(self.dom[low.bit_length() - 1])
+            mask ^= low
         return vals
 
+    def cur_domain_mask(self):
+        '''return the CURRENT domain as a bitmask over self.dom (if
+           assigned only the assigned value's bit is set)'''
+        if self.assignedValue is None:
+            return self.curdom
+        return 1 << self.dom_index[self.assignedValue]
+
     def in_cur_domain(self, value):
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
            domain'''
-        if not value in self.dom:
+        i = self.dom_index.get(value)
+        if i is None:
             return False
         if self.is_assigned():
             return value == self.get_assigned_value()
         else:
-            return self.curdom[self.value_index(value)]
+            return (self.curdom >> i) & 1 == 1
 
     def cur_domain_size(self):
         '''Return the size of the variables domain (without construcing list)'''
         if self.is_assigned():
             return 1
         else:
-            return(sum(1 for v in self.curdom if v))
+            return popcount(self.curdom)
 
     def restore_curdom(self):
         '''return all values back into CURRENT domain'''
-        for i in range(len(self.curdom)):
-            self.curdom[i] = True
+        self.curdom = (1 << len(self.dom)) - 1
+        if self.listener is not None:
+            self.listener(self)
+
+    def restore_state(self, curdom):
+        '''Used by Trail.undo_to to reset the CURRENT domain to a
+           previously recorded bitmask'''
+        self.curdom = curdom
+        if self.listener is not None:
+            self.listener(self)
 
     #
     #methods for assigning and unassigning
@@ -165,6 +228,9 @@ class Variable:
             return
 
         self.assignedValue = value
+        for c, p in self.watches:
+            c.unasgn_count = c.unasgn_count - 1
+            c.unasgn_pos_sum = c.unasgn_pos_sum - p
 
     def unassign(self):
         '''Used by bt_search. Unassign and restore old curdom'''
@@ -172,6 +238,11 @@ class Variable:
             print("ERROR: trying to unassign variable", self, " not yet assigned")
             return
         self.assignedValue = None
+        for c, p in self.watches:
+            c.unasgn_count = c.unasgn_count + 1
+            c.unasgn_pos_sum = c.unasgn_pos_sum + p
+        if self.listener is not None:
+            self.listener(self)
 
     def get_assigned_value(self):
         '''return assigned value...returns None if is unassigned'''
@@ -184,7 +255,7 @@ class Variable:
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
            in the domain list of a variable value'''
-        return self.dom.index(value)
+        return self.dom_index[value]
 
     def __repr__(self):
         return("Var-{}".format(self.name))
@@ -196,7 +267,380 @@ class Variable:
         '''Also print the variable domain and current domain'''
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
-                                                             self.curdom))
+                                                             [(self.curdom >> i) & 1 == 1
+                                                              for i in range(len(self.dom))]))
+class TupleTable:
+    '''Compact storage for the satisfying tuples of a table constraint.
+
+       Tuples are stored by value INDEX (the position of each value in
+       the domain of its scope position) rather than as Python tuples:
+       'rows' is one contiguous integer array holding every tuple back to
+       back (arity entries each), sorted and free of duplicates, and
+       'codes' holds the mixed-radix encoding of each row (membership
+       tests look codes up in a bitmap or set built from them, see
+       contains). The supports of value index j at scope position
+       p are the tuple numbers sup_ids[p][sup_start[p][j]:sup_start[p][j+1]].
+
+       The layout is kept in array.array objects, value indices and
+       tuple numbers in the narrowest integer type that fits. The codes
+       are encoded into one array as the tuples come in, so no Python
+       object is kept per tuple while building. Support lists shorter
+       than VECTOR_MIN are scanned in Python (for a few tuples that is
+       much faster than calling numpy); with numpy, longer ones are
+       checked with one vectorized mask over numpy views of the same
+       arrays.
+       Tuples with a value outside the domain of its position can never
+       be valid and are dropped.
+
+       A table is immutable once built, and it is indexed by scope
+       position rather than by variable, so any number of constraints
+       whose positions have the same domains can share it (see intern
+       and Constraint.set_table); only per-constraint search state such
+       as residues lives in the constraint.'''
+
+    #interned tables: (domains, hash of codes) --> table
+    interned = weakref.WeakValueDictionary()
+
+    #support lists at least this long are checked with numpy
+    VECTOR_MIN = 64
+
+    def __init__(self, domains, tuples=[], base=None):
+        '''Build the table over the given per-position domains from
+           'tuples' plus, if given, all tuples of the table base'''
+        self.domains = [list(d) for d in domains]
+        self.arity = len(self.domains)
+        self.index = []             #per position: value --> value index
+        for d in self.domains:
+            idx = dict()
+            for j, val in enumerate(d):
+                idx.setdefault(val, j)
+            self.index.append(idx)
+        self.sizes = [len(d) for d in self.domains]
+        space = 1
+        for d in self.domains:
+            space = space * max(len(d), 1)
+        self.space = space
+        #codes must fit a signed 64 bit integer to live in an array
+        self.vectorized = numpy is not None and space < 2 ** 63
+        self.compact_codes = space < 2 ** 63
+        self.masks = dict()         #(p, j) --> support_mask(p, j), filled on demand
+        self.pair_masks = dict()    #(p, j) --> pair_mask(p, j), filled on demand
+        self.member_bits = None     #bitmap of the codes, or
+        self.members = None         #set of the codes, see build_members
+        self.build(self.stream_codes(tuples, base))
+
+    def stream_codes(self, tuples, base=None):
+        '''Internal routine. Return the codes of base's tuples and of
+           'tuples' in one integer array, encoding one tuple at a time
+           (so 'tuples' may be a generator)'''
+        codes = array('q') if self.compact_codes else []
+        if base is not None and self.compact_codes:
+            codes.frombytes(base.codes.tobytes())
+        elif base is not None:
+            codes.extend(base.codes)
+        encode = self.encode
+        for t in tuples:
+            code = encode(t)
+            if code is not None:
+                codes.append(code)
+        return codes
+
+    def encode(self, vals):
+        '''Return the code of a tuple of values, None if some value is
+           not in the domain of its position'''
+        code = 0
+        for idx, size, val in zip(self.index, self.sizes, vals):
+            j = idx.get(val)
+            if j is None:
+                return None
+            code = code * size + j
+        return code
+
+    def build(self, codes):
+        '''Internal routine. Build the arrays from the codes of the
+           tuples (any order, duplicates allowed)'''
+        k = self.arity
+        sizes = self.sizes
+        width = max(sizes + [1])
+        #value indices and tuple numbers are stored in the narrowest
+        #integer type that fits
+        if width <= 2 ** 8:
+            typecode, dtype = 'B', 'uint8'
+        elif width <= 2 ** 16:
+            typecode, dtype = 'H', 'uint16'
+        else:
+            typecode, dtype = 'i', 'int32'
+        if self.vectorized:
+            codes = numpy.unique(numpy.asarray(codes, dtype=numpy.int64))
+        else:
+            codes = self.sorted_codes(codes)
+        n = len(codes)
+        idcode, iddtype = ('H', 'uint16') if n <= 2 ** 16 else ('i', 'int32')
+        rows = array(typecode, [0]) * (n * k)
+        self.sup_ids = []
+        self.sup_start = []
+        if self.vectorized:
+            #fill the arrays in place through numpy views of them
+            self.np_rows = numpy.frombuffer(rows, dtype=dtype).reshape(n, k)
+            self.np_ids = []
+            stride = 1
+            for p in range(k - 1, -1, -1):
+                self.np_rows[:, p] = (codes // stride) % sizes[p]
+                stride = stride * sizes[p]
+            for p in range(k):
+                col = self.np_rows[:, p]
+                ids = array(idcode, [0]) * n
+                np_ids = numpy.frombuffer(ids, dtype=iddtype)
+                np_ids[:] = numpy.argsort(col, kind='stable')
+                start = numpy.zeros(sizes[p] + 1, dtype=numpy.int64)
+                numpy.cumsum(numpy.bincount(col, minlength=sizes[p]), out=start[1:])
+                self.sup_ids.append(ids)
+                self.sup_start.append(array('q', start.tobytes()))
+                self.np_ids.append(np_ids)
+        else:
+            stride = 1
+            for p in range(k - 1, -1, -1):
+                size = sizes[p]
+                rows[p::k] = array(typecode, [c // stride % size for c in codes])
+                stride = stride * size
+            for p in range(k):
+                #counting sort of the tuple numbers by their value at p
+                col = rows[p::k]
+                count = [0] * (sizes[p] + 1)
+                for j in col:
+                    count[j + 1] = count[j + 1] + 1
+                start = array('q', itertools.accumulate(count))
+                fill = list(start)
+                ids = array(idcode, [0]) * n
+                for t, j in enumerate(col):
+                    ids[fill[j]] = t
+                    fill[j] = fill[j] + 1
+                self.sup_ids.append(ids)
+                self.sup_start.append(start)
+        self.rows = rows
+        self.codes = codes
+        self.n_tuples = n
+
+    def sorted_codes(self, codes):
+        '''Internal routine. Return codes sorted, without duplicates'''
+        uniq = array('q') if self.compact_codes else []
+        last = None
+        for code in sorted(codes):
+            if code != last:
+                uniq.append(code)
+                last = code
+        return uniq
+
+    def key(self):
+        '''Internal routine. Hashable summary used to intern the table'''
+        if self.compact_codes:
+            digest = hash(self.codes.tobytes())
+        else:
+            digest = hash(tuple(self.codes))
+        return (tuple(tuple(d) for d in self.domains), digest)
+
+    def same_tuples(self, other):
+        if self.domains != other.domains or self.n_tuples != other.n_tuples:
+            return False
+        if self.vectorized and other.vectorized:
+            return bool(numpy.array_equal(self.codes, other.codes))
+        return list(self.codes) == list(other.codes)
+
+    @staticmethod
+    def intern(table):
+        '''Return the live table with the same domains and tuples as
+           table if there is one, otherwise register and return table'''
+        key = table.key()
+        other = TupleTable.interned.get(key)
+        if other is not None and other.same_tuples(table):
+            return other
+        if other is None:
+            TupleTable.interned[key] = table
+        return table
+
+    @staticmethod
+    def from_codes(domains, codes):
+        '''Return the (interned) table over domains holding the tuples
+           with the given codes, e.g., the codes of a table sent by
+           CSP.compact'''
+        table = TupleTable(domains)
+        table.build(codes)
+        return TupleTable.intern(table)
+
+    def __len__(self):
+        return self.n_tuples
+
+    def contains(self, vals):
+        '''Return True iff the tuple of values vals is in the table. O(1)
+           (for a fixed arity): this is what prop_BT checks.'''
+        code = self.encode(vals)
+        if code is None:
+            return False
+        if self.member_bits is None and self.members is None:
+            self.build_members()
+        bits = self.member_bits
+        if bits is not None:
+            return (bits[code >> 3] >> (code & 7)) & 1 == 1
+        return code in self.members
+
+    def build_members(self):
+        '''Internal routine. Build the index of the codes used by
+           contains, on first use: a bitmap over the whole space of codes
+           when it takes at most 64 bytes per tuple, otherwise a set'''
+        if self.space > 512 * max(self.n_tuples, 1):
+            if self.vectorized:
+                self.members = set(self.codes.tolist())
+            else:
+                self.members = set(self.codes)
+        elif self.vectorized:
+            bits = numpy.zeros((self.space + 7) // 8, dtype=numpy.uint8)
+            numpy.bitwise_or.at(bits, self.codes >> 3,
+                                numpy.left_shift(1, self.codes & 7).astype(numpy.uint8))
+            self.member_bits = bytearray(bits.tobytes())
+        else:
+            bits = bytearray((self.space + 7) // 8)
+            for code in self.codes:
+                bits[code >> 3] |= 1 << (code & 7)
+            self.member_bits = bits
+
+    def row(self, t):
+        '''return the value indices of tuple number t'''
+        k = self.arity
+        return list(self.rows[t * k:(t + 1) * k])
+
+    def tuples(self):
+        '''Iterate over the tuples as Python tuples of values'''
+        for t in range(len(self)):
+            yield tuple(d[j] for d, j in zip(self.domains, self.row(t)))
+
+    def support_ids(self, p, j):
+        '''Return the numbers of the tuples with value index j at position p'''
+        if j >= len(self.domains[p]):
+            return self.sup_ids[p][0:0]
+        return self.sup_ids[p][self.sup_start[p][j]:self.sup_start[p][j + 1]]
+
+    def support_mask(self, p, j):
+        '''Return support_ids(p, j) as a bitmask over tuple numbers'''
+        mask = self.masks.get((p, j))
+        if mask is not None:
+            return mask
+        ids = self.support_ids(p, j)
+        n = len(self)
+        if self.vectorized:
+            bits = numpy.zeros(n, dtype=numpy.uint8)
+            bits[self.np_ids[p][self.sup_start[p][j]:self.sup_start[p][j + 1]]] = 1
+            mask = int.from_bytes(numpy.packbits(bits, bitorder='little').tobytes(), 'little')
+        else:
+            bits = bytearray((n + 7) // 8)
+            for t in ids:
+                bits[t >> 3] |= 1 << (t & 7)
+            mask = int.from_bytes(bytes(bits), 'little')
+        self.masks[(p, j)] = mask
+        return mask
+
+    def pair_mask(self, p, j):
+        '''Binary tables only. Return the bitmask over the value indices
+           of the other position of the values that form a tuple with
+           value index j at position p'''
+        mask = self.pair_masks.get((p, j))
+        if mask is None:
+            q = 1 - p
+            rows = self.rows
+            mask = 0
+            for t in self.support_ids(p, j):
+                mask |= 1 << rows[2 * t + q]
+            self.pair_masks[(p, j)] = mask
+        return mask
+
+    def row_is_valid(self, t, masks):
+        '''Check tuple number t against the current domain bitmasks'''
+        rows = self.rows
+        base = t * self.arity
+        for p in range(self.arity):
+            if not (masks[p] >> int(rows[base + p])) & 1:
+                return False
+        return True
+
+    def allowed(self, masks):
+        '''Internal routine (numpy only). Boolean matrix, allowed[q, j]
+           is True iff value index j is allowed at position q by masks'''
+        k = self.arity
+        width = max(len(d) for d in self.domains)
+        allowed = numpy.zeros((k, width), dtype=bool)
+        for q in range(k):
+            size = len(self.domains[q])
+            raw = masks[q].to_bytes((size + 7) // 8, 'little')
+            bits = numpy.unpackbits(numpy.frombuffer(raw, dtype=numpy.uint8), bitorder='little')
+            allowed[q, :size] = bits[:size]
+        return allowed
+
+    def find_support(self, p, j, masks, start=0):
+        '''Return the position, within support_ids(p, j), of a tuple all
+           of whose values are allowed by the domain bitmasks 'masks'
+           (one per scope position), searching from 'start' and wrapping
+           around. Return -1 if there is none.'''
+        if j >= len(self.domains[p]):
+            return -1
+        first = self.sup_start[p][j]
+        m = self.sup_start[p][j + 1] - first
+        if m == 0:
+            return -1
+        if start >= m:
+            start = 0
+        all_ids = self.sup_ids[p]
+        k = self.arity
+        if self.vectorized and m >= self.VECTOR_MIN:
+            if self.row_is_valid(all_ids[first + start], masks):
+                return start
+            rows = self.np_rows[self.np_ids[p][first:first + m]]
+            ok = numpy.flatnonzero(self.allowed(masks)[numpy.arange(k), rows].all(axis=1))
+            if len(ok) == 0:
+                return -1
+            after = ok[ok >= start]
+            return int(after[0]) if len(after) else int(ok[0])
+        rows = self.rows
+        for i in range(start, start + m):
+            if i >= m:
+                i = i - m
+            base = all_ids[first + i] * k
+            for q in range(k):
+                if not (masks[q] >> rows[base + q]) & 1:
+                    break
+            else:
+                return i
+        return -1
+
+    def count_supports(self, p, j, masks):
+        '''Return how many tuples with value index j at position p have
+           all their values allowed by the domain bitmasks in masks.
+           O(1) for binary tables (see pair_mask), otherwise a scan of
+           the support list of j.'''
+        if j >= len(self.domains[p]):
+            return 0
+        if self.arity == 2:
+            if not (masks[p] >> j) & 1:
+                return 0
+            return popcount(self.pair_mask(p, j) & masks[1 - p])
+        first = self.sup_start[p][j]
+        last = self.sup_start[p][j + 1]
+        if first == last:
+            return 0
+        all_ids = self.sup_ids[p]
+        k = self.arity
+        if self.vectorized and last - first >= self.VECTOR_MIN:
+            rows = self.np_rows[self.np_ids[p][first:last]]
+            return int(self.allowed(masks)[numpy.arange(k), rows].all(axis=1).sum())
+        rows = self.rows
+        n = 0
+        for i in range(first, last):
+            base = all_ids[i] * k
+            for q in range(k):
+                if not (masks[q] >> rows[base + q]) & 1:
+                    break
+            else:
+                n = n + 1
+        return n
+
 class Constraint: 
     '''Class for defining constraints variable objects specifes an
        ordering over variables.  This ordering is used when calling
@@ -212,41 +656,117 @@ class Constraint:
         Consraints are implemented as storing a set of satisfying
         tuples (i.e., each tuple specifies a value for each variable
         in the scope such that this sequence of values satisfies the
-        constraints).
+        constraints). The tuples are kept in a TupleTable, which stores
+        them as arrays of value indices together with the index of the
+        tuples supporting each variable/value pair (used for GAC).
 
-        NOTE: This is a very space expensive representation...a proper
-        constraint object would allow for representing the constraint
-        with a function.  
+        NOTE: Tables are still exponential in the arity...subclasses
+        such as FunctionConstraint represent the constraint with a
+        function instead.
         '''
 
         self.scope = list(scope)
         self.name = name
-        self.sat_tuples = dict()
-
-        #The next object data item 'sup_tuples' will be used to help
-        #support GAC propgation. It allows access to a list of 
-        #satisfying tuples that contain a particular variable/value
-        #pair.
-        self.sup_tuples = dict()
+        self.table = None               #(shared) TupleTable of satisfying tuples
+        self.sat_view = None            #sat_tuples and sup_tuples, built on first access
+        self.sup_view = None
+        self.position = dict()          #var --> (first) position in scope
+        for i, var in enumerate(self.scope):
+            self.position.setdefault(var, i)
+
+        #the number of unassigned scope positions and the sum of those
+        #positions, which is THE unassigned position when only one is
+        #left. Once the constraint is added to a CSP the scope variables
+        #update them on assign and unassign (see watch); before that they
+        #are recounted when asked for.
+        self.watched = False
+        self.unasgn_count = 0
+        self.unasgn_pos_sum = 0
+
+        #'weight' counts the dead ends this constraint caused (plus one);
+        #used by the dom/wdeg variable ordering
+        self.weight = 1
+
+        #counted by the propagators for BT.get_stats: revisions of the
+        #constraint, and values (or tuples) checked for support
+        self.revisions = 0
+        self.checks = 0
+
+        #'residues' remembers, for each variable/value pair, the position
+        #in the pair's support list of the last support found by
+        #has_support (GAC-3rm style). A residue is always re-validated
+        #before it is used, so it never needs to be restored on backtracking.
+        self.residues = dict()
 
     def add_satisfying_tuples(self, tuples):
-        '''We specify the constraint by adding its complete list of satisfying tuples.'''
-        for x in tuples:
-            t = tuple(x)  #ensure we have an immutable tuple
-            if not t in self.sat_tuples:
-                self.sat_tuples[t] = True
-
-            #now put t in as a support for all of the variable values in it
-            for i, val in enumerate(t):
-                var = self.scope[i]
-                if not (var, val) in self.sup_tuples:
-                    self.sup_tuples[(var, val)] = []
-                self.sup_tuples[(var, val)].append(t)
+        '''We specify the constraint by adding its complete list of satisfying tuples.
+           Tables are immutable and shared, so adding builds a new table
+           (interned: constraints with the same relation end up sharing one).'''
+        table = TupleTable([var.domain() for var in self.scope], tuples, self.table)
+        self.set_table(TupleTable.intern(table))
+
+    def set_table(self, table):
+        '''Use the TupleTable 'table' (e.g., one shared with other
+           constraints over the same relation) as the satisfying tuples.
+           Its domains must be those of the scope, position by position.'''
+        if table.domains != [var.domain() for var in self.scope]:
+            print("ERROR: table domains do not match the scope of constraint", self)
+            return
+        self.table = table
+        self.residues = dict()
+        self.sat_view = None
+        self.sup_view = None
+
+    @property
+    def sat_tuples(self):
+        '''dict of the satisfying tuples. Built from the table on first
+           access and kept until the table changes: it holds every tuple
+           as a Python tuple, so it costs the memory the table saves.'''
+        if self.sat_view is None:
+            self.sat_view = dict()
+            if self.table is not None:
+                self.sat_view = dict.fromkeys(self.table.tuples(), True)
+        return self.sat_view
+
+    @property
+    def sup_tuples(self):
+        '''dict mapping (var, val) to the list of satisfying tuples
+           containing that pair. Built and kept like sat_tuples.'''
+        if self.sup_view is None:
+            sup = dict()
+            if self.table is not None:
+                for t in self.table.tuples():
+                    for i, val in enumerate(t):
+                        sup.setdefault((self.scope[i], val), []).append(t)
+            self.sup_view = sup
+        return self.sup_view
 
     def get_scope(self):
         '''get list of variables the constraint is over'''
         return list(self.scope)
 
+    def compact_args(self, table_id):
+        '''Return the arguments that, besides name and scope, rebuild
+           this constraint in another process (see CSP.compact).
+           table_id(table) gives the number of a table in the CSP's
+           list of shared tables.'''
+        return table_id(self.table)
+
+    @classmethod
+    def from_compact(cls, name, scope, args, tables):
+        '''Rebuild a constraint from the output of compact_args'''
+        c = cls(name, scope)
+        if args is not None:
+            c.set_table(tables[args])
+        return c
+
+    def bump_weight(self):
+        '''Called by the propagators when this constraint causes a dead end'''
+        self.weight = self.weight + 1
+        for var in self.scope:
+            if var.listener is not None:
+                var.listener(var)
+
     def check(self, vals):
         '''Given list of values, one for each variable in the
            constraints scope, return true if and only if these value
@@ -254,23 +774,59 @@ class Constraint:
            constraints "satisfies" function.  Note the list of values
            are must be ordered in the same order as the list of
            variables in the constraints scope'''
-        return tuple(vals) in self.sat_tuples
+        return self.table is not None and self.table.contains(vals)
+
+    def watch(self):
+        '''Internal routine, called by CSP.add_constraint. Have the scope
+           variables keep the unassigned counters up to date from now on'''
+        if self.watched:
+            return
+        self.watched = True
+        for i, var in enumerate(self.scope):
+            var.watches.append((self, i))
+        self.count_unasgn()
+
+    def count_unasgn(self):
+        '''Internal routine. Recount the unassigned scope positions'''
+        self.unasgn_count = 0
+        self.unasgn_pos_sum = 0
+        for i, var in enumerate(self.scope):
+            if not var.is_assigned():
+                self.unasgn_count = self.unasgn_count + 1
+                self.unasgn_pos_sum = self.unasgn_pos_sum + i
 
     def get_n_unasgn(self):
-        '''return the number of unassigned variables in the constraint's scope'''
-        n = 0
-        for v in self.scope:
-            if not v.is_assigned():
-                n = n + 1
-        return n
+        '''return the number of unassigned variables in the constraint's
+           scope. O(1) once the constraint is in a CSP.'''
+        if not self.watched:
+            self.count_unasgn()
+        return self.unasgn_count
+
+    def get_last_unasgn_var(self):
+        '''return the only unassigned variable in the constraint's scope,
+           None if there is not exactly one. O(1) once the constraint is
+           in a CSP.'''
+        if not self.watched:
+            self.count_unasgn()
+        if self.unasgn_count != 1:
+            return None
+        return self.scope[self.unasgn_pos_sum]
 
     def get_unasgn_vars(self): 
         '''return list of unassigned variables in constraint's scope. Note
            more expensive to get the list than to then number'''
+        if not self.watched:
+            self.count_unasgn()
+        n = self.unasgn_count
+        if n == len(self.scope):
+            return list(self.scope)
+        if n == 1:
+            return [self.scope[self.unasgn_pos_sum]]
         vs = []
-        for v in self.scope:
-            if not v.is_assigned():
-                vs.append(v)
+        if n:
+            for v in self.scope:
+                if not v.is_assigned():
+                    vs.append(v)
         return vs
 
     def has_support(self, var, val):
@@ -278,11 +834,42 @@ class Constraint:
            of assignments satisfying the constraint where each value is
            still in the corresponding variables current domain
         '''
-        if (var, val) in self.sup_tuples:
-            for t in self.sup_tuples[(var, val)]:
-                if self.tuple_is_valid(t):
-                    return True
-        return False
+        if self.table is None:
+            return False
+        p = self.position.get(var)
+        j = var.dom_index.get(val)
+        if p is None or j is None:
+            return False
+        masks = [v.cur_domain_mask() for v in self.scope]
+        key = (p, j)
+        #resume the search at the residue, wrapping around to the front
+        i = self.table.find_support(p, j, masks, self.residues.get(key, 0))
+        if i < 0:
+            return False
+        self.residues[key] = i
+        return True
+
+    def support_count(self, var, val):
+        '''Return how strongly var = val is supported by the constraint
+           given the current domains (higher = less constraining); used
+           by the least-constraining-value ordering. For a table this is
+           the number of still valid tuples containing var = val.'''
+        if self.table is None:
+            return 0
+        p = self.position.get(var)
+        j = var.dom_index.get(val)
+        if p is None or j is None:
+            return 0
+        masks = [v.cur_domain_mask() for v in self.scope]
+        masks[p] = 1 << j
+        return self.table.count_supports(p, j, masks)
+
+    def priority(self):
+        '''Revision cost class used by ConstraintQueue; constraints
+           with a lower priority are revised first. For a table this is
+           the order of magnitude of its number of satisfying tuples,
+           so small (binary) tables go before large n-ary ones.'''
+        return (len(self.table) if self.table is not None else 0).bit_length()
 
     def tuple_is_valid(self, t):
         '''Internal routine. Check if every value in tuple is still in
@@ -295,6 +882,485 @@ class Constraint:
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+class CompactTableConstraint(Constraint):
+    '''Table constraint propagated with Compact-Table (CT).
+
+       It is specified exactly like a Constraint (add_satisfying_tuples),
+       so any table can be switched to CT by constructing this class
+       instead. The tuples are numbered and, for each scope position and
+       domain value, a bitmask (a Python int) of the tuples holding that
+       value is built from the support index of its TupleTable. The
+       constraint keeps 'valid', the bitmask of tuples whose values are
+       all still current, and updates it incrementally from the domain
+       changes since its last revision, so has_support is a single AND.
+       'valid' is reversible: changes are recorded on the trail of the
+       scope variables during bt_search.'''
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+        self.masks = None           #masks[i][value index] --> tuples with that value
+        self.valid = 0              #tuples all of whose values are current
+        self.last = None            #domain masks 'valid' was computed for
+
+    def set_table(self, table):
+        Constraint.set_table(self, table)
+        self.masks = None
+
+    def build_masks(self):
+        '''Internal routine. Number the tuples and build the support masks'''
+        self.masks = [[0] * var.domain_size() for var in self.scope]
+        table = self.table
+        if table is not None:
+            for i in range(len(self.scope)):
+                for j in range(min(len(table.domains[i]), len(self.masks[i]))):
+                    self.masks[i][j] = table.support_mask(i, j)
+        self.all_tuples = (1 << (len(table) if table is not None else 0)) - 1
+        self.last = None
+
+    def restore_state(self, state):
+        self.valid, self.last = state
+
+    def update_valid(self):
+        '''Internal routine. Bring 'valid' up to date with the current
+           domains of the scope'''
+        if self.masks is None:
+            self.build_masks()
+        cur = tuple([var.cur_domain_mask() for var in self.scope])
+        last = self.last
+        if cur == last:
+            return
+        trail = self.scope[0].trail if self.scope else None
+        if trail is not None:
+            trail.push(self, (self.valid, last))
+
+        reset = last is None
+        if not reset:
+            for i in range(len(cur)):
+                if cur[i] & ~last[i]:
+                    #values came back without the trail restoring us
+                    reset = True
+                    break
+        valid = self.all_tuples if reset else self.valid
+        for i in range(len(cur)):
+            if not reset and cur[i] == last[i]:
+                continue
+            masks = self.masks[i]
+            removed = 0 if reset else last[i] & ~cur[i]
+            if not reset and popcount(removed) < popcount(cur[i]):
+                #fewer values removed than left: clear the removed ones
+                dead = 0
+                while removed:
+                    low = removed & -removed
+                    dead |= masks[low.bit_length() - 1]
+                    removed ^= low
+                valid &= ~dead
+            else:
+                alive = 0
+                m = cur[i]
+                while m:
+                    low = m & -m
+                    alive |= masks[low.bit_length() - 1]
+                    m ^= low
+                valid &= alive
+        self.valid = valid
+        self.last = cur
+
+    def has_support(self, var, val):
+        if not var.in_cur_domain(val):
+            return False
+        self.update_valid()
+        return self.valid & self.masks[self.position[var]][var.value_index(val)] != 0
+
+    def support_count(self, var, val):
+        #the valid tuple bitset already holds the counts
+        if not var.in_cur_domain(val):
+            return 0
+        self.update_valid()
+        return popcount(self.valid & self.masks[self.position[var]][var.value_index(val)])
+
+class FunctionConstraint(Constraint):
+    '''Constraint defined intensionally by a check function instead of
+       a table of satisfying tuples.
+
+       check_fn is called with a tuple of values, one for each variable
+       of the scope (in scope order), and returns True iff they satisfy
+       the constraint. Nothing is enumerated when the constraint is
+       built; has_support searches the current domains of the other
+       variables lazily, stopping at the first satisfying tuple, and
+       remembers it as a residue for the next call.'''
+
+    def __init__(self, name, scope, check_fn):
+        Constraint.__init__(self, name, scope)
+        self.check_fn = check_fn
+        size = 1
+        for var in self.scope:
+            size = size * var.domain_size()
+        self.cost = size.bit_length()
+
+    def add_satisfying_tuples(self, tuples):
+        print("ERROR: trying to add satisfying tuples to function constraint", self)
+
+    def compact_args(self, table_id):
+        #check_fn is sent by reference, so it must be a module level function
+        return self.check_fn
+
+    @classmethod
+    def from_compact(cls, name, scope, args, tables):
+        return cls(name, scope, args)
+
+    def check(self, vals):
+        return bool(self.check_fn(tuple(vals)))
+
+    def has_support(self, var, val):
+        key = (var, val)
+        t = self.residues.get(key)
+        if t is not None and self.tuple_is_valid(t):
+            return True
+        if not var.in_cur_domain(val):
+            return False
+
+        doms = []
+        for v in self.scope:
+            if v is var:
+                doms.append((val,))
+            else:
+                doms.append(v.cur_domain())
+        for t in itertools.product(*doms):
+            if self.check_fn(t):
+                self.residues[key] = t
+                return True
+        return False
+
+    def support_count(self, var, val):
+        return 0
+
+    def priority(self):
+        return self.cost
+
+class AllDifferentConstraint(Constraint):
+    '''Global all-different constraint over its scope, filtered with
+       Regin's bipartite matching algorithm.
+
+       No tuples are stored. Whenever the current domains of the scope
+       have changed since the last call, has_support rebuilds the set of
+       supported (variable, value) pairs: a value is supported iff it
+       belongs to some maximum matching of the variable/value graph,
+       i.e. it is matched, lies on an alternating cycle (same strongly
+       connected component) or is reachable from a free value. That is
+       full GAC in O(k*d) per recomputation rather than a scan over the
+       k! permutation tuples.'''
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+        self.match = [None] * len(self.scope)   #last maximum matching
+        self.signature = None       #domain masks the supports were built for
+        self.supported = set()      #supported (position, value) pairs
+        self.cost = (len(self.scope) * max([var.domain_size() for var in self.scope] + [1])).bit_length()
+
+    def add_satisfying_tuples(self, tuples):
+        print("ERROR: trying to add satisfying tuples to all-different constraint", self)
+
+    def check(self, vals):
+        return len(set(vals)) == len(vals)
+
+    def has_support(self, var, val):
+        signature = tuple([v.cur_domain_mask() for v in self.scope])
+        if signature != self.signature:
+            self.signature = signature
+            self.supported = self.find_supported()
+        return (self.position.get(var), val) in self.supported
+
+    def support_count(self, var, val):
+        #minus the number of other unassigned variables that would lose val
+        n = 0
+        for v in self.scope:
+            if v is not var and not v.is_assigned() and v.in_cur_domain(val):
+                n = n + 1
+        return -n
+
+    def priority(self):
+        return self.cost
+
+    def find_supported(self):
+        '''Internal routine. Return the set of (position, value) pairs
+           that belong to some maximum matching covering the scope'''
+        k = len(self.scope)
+        doms = [var.cur_domain() for var in self.scope]
+
+        #maximum matching, warm started from the previous one
+        match = self.match
+        owner = dict()              #value --> position matched to it
+        for i in range(k):
+            a = match[i]
+            if a is not None and a in doms[i] and not a in owner:
+                owner[a] = i
+            else:
+                match[i] = None
+
+        def augment(i, seen):
+            for a in doms[i]:
+                if not a in seen:
+                    seen.add(a)
+                    j = owner.get(a)
+                    if j is None or augment(j, seen):
+                        match[i] = a
+                        owner[a] = i
+                        return True
+            return False
+
+        for i in range(k):
+            if match[i] is None and not augment(i, set()):
+                return set()
+
+        #Orient matching edges var --> value and the other edges
+        #value --> var. Node ids: positions 0..k-1, then values.
+        node = dict()
+        for d in doms:
+            for a in d:
+                if not a in node:
+                    node[a] = k + len(node)
+        n_nodes = k + len(node)
+        succ = [[] for _ in range(n_nodes)]
+        for i in range(k):
+            succ[i].append(node[match[i]])
+            for a in doms[i]:
+                if a != match[i]:
+                    succ[node[a]].append(i)
+
+        #values reachable from a free value by an even alternating path
+        reached = [False] * n_nodes
+        stack = [node[a] for a in node if not a in owner]
+        for u in stack:
+            reached[u] = True
+        while stack:
+            u = stack.pop()
+            for w in succ[u]:
+                if not reached[w]:
+                    reached[w] = True
+                    stack.append(w)
+
+        comp = strongly_connected_components(succ)
+
+        supported = set()
+        for i in range(k):
+            for a in doms[i]:
+                u = node[a]
+                if a == match[i] or reached[u] or comp[u] == comp[i]:
+                    supported.add((i, a))
+        return supported
+
+class BoundsConstraint(Constraint):
+    '''Base class for arithmetic constraints over numeric domains that
+       are propagated by reasoning on domain bounds instead of tuples.
+
+       Whenever the current domains of the scope have changed since the
+       last call, the smallest and largest current value of each scope
+       variable are recomputed (once) and passed to update_bounds;
+       subclasses then answer has_support from what they derived there
+       without touching the domains again.'''
+
+    def __init__(self, name, scope, target):
+        Constraint.__init__(self, name, scope)
+        self.target = target
+        self.signature = None
+        self.lo = []                #smallest current value of each scope var
+        self.hi = []                #largest current value of each scope var
+        self.wiped_out = False      #some scope var has an empty domain
+
+    def add_satisfying_tuples(self, tuples):
+        print("ERROR: trying to add satisfying tuples to bounds constraint", self)
+
+    def compact_args(self, table_id):
+        return self.target
+
+    @classmethod
+    def from_compact(cls, name, scope, args, tables):
+        return cls(name, scope, args)
+
+    def priority(self):
+        return len(self.scope).bit_length()
+
+    def support_count(self, var, val):
+        return 0
+
+    def has_support(self, var, val):
+        if not var.in_cur_domain(val):
+            return False
+        signature = tuple([v.cur_domain_mask() for v in self.scope])
+        if signature != self.signature:
+            self.signature = signature
+            self.wiped_out = False
+            self.lo = []
+            self.hi = []
+            for v in self.scope:
+                dom = v.cur_domain()
+                if not dom:
+                    self.wiped_out = True
+                    break
+                self.lo.append(min(dom))
+                self.hi.append(max(dom))
+            self.update_bounds()
+        if self.wiped_out:
+            return False
+        return self.is_supported(self.position[var], val)
+
+    def update_bounds(self):
+        '''Hook for subclasses, called after lo/hi are recomputed'''
+        pass
+
+    def is_supported(self, i, val):
+        '''Return True iff scope[i] = val (a current value) has a support
+           given the current domains of the other scope variables'''
+        raise NotImplementedError
+
+class SumConstraint(BoundsConstraint):
+    '''Linear equation  sum(weights[i] * scope[i]) == target. weights
+       default to all 1s.
+
+       A value is first tested against the bounds of the other terms in
+       O(1). Values that pass are checked against the sets of partial
+       sums reachable by the terms before and after them, built once per
+       domain change, which makes the constraint GAC without ever
+       enumerating tuples.'''
+
+    def __init__(self, name, scope, target, weights=None):
+        BoundsConstraint.__init__(self, name, scope, target)
+        if weights is None:
+            weights = [1] * len(self.scope)
+        self.weights = list(weights)
+
+    def compact_args(self, table_id):
+        return (self.target, self.weights)
+
+    @classmethod
+    def from_compact(cls, name, scope, args, tables):
+        target, weights = args
+        return cls(name, scope, target, weights)
+
+    def check(self, vals):
+        return sum(w * v for w, v in zip(self.weights, vals)) == self.target
+
+    def update_bounds(self):
+        #contribution range of each term, and of the whole sum
+        self.term_lo = []
+        self.term_hi = []
+        for w, lo, hi in zip(self.weights, self.lo, self.hi):
+            if w >= 0:
+                self.term_lo.append(w * lo)
+                self.term_hi.append(w * hi)
+            else:
+                self.term_lo.append(w * hi)
+                self.term_hi.append(w * lo)
+        self.sum_lo = sum(self.term_lo)
+        self.sum_hi = sum(self.term_hi)
+        self.prefix_sums = None     #built on the first value passing the bounds
+
+    def is_supported(self, i, val):
+        rest = self.target - self.weights[i] * val
+        if not self.sum_lo - self.term_lo[i] <= rest <= self.sum_hi - self.term_hi[i]:
+            return False
+        if self.prefix_sums is None:
+            self.build_partial_sums()
+        suffix = self.suffix_sums[i]
+        for p in self.prefix_sums[i]:
+            if rest - p in suffix:
+                return True
+        return False
+
+    def build_partial_sums(self):
+        '''Internal routine. prefix_sums[i] (suffix_sums[i]) is the set of
+           sums reachable by the terms before (after) position i'''
+        terms = []
+        for w, var in zip(self.weights, self.scope):
+            terms.append(set(w * v for v in var.cur_domain()))
+        k = len(terms)
+        self.prefix_sums = [None] * k
+        self.suffix_sums = [None] * k
+        sums = set([0])
+        for i in range(k):
+            self.prefix_sums[i] = sums
+            sums = set(p + t for p in sums for t in terms[i])
+        sums = set([0])
+        for i in range(k - 1, -1, -1):
+            self.suffix_sums[i] = sums
+            sums = set(p + t for p in sums for t in terms[i])
+
+class MinConstraint(BoundsConstraint):
+    '''min(scope) >= target, i.e. every variable takes a value >= target'''
+
+    def check(self, vals):
+        return min(vals) >= self.target
+
+    def update_bounds(self):
+        self.n_bad = sum(1 for hi in self.hi if hi < self.target)
+
+    def is_supported(self, i, val):
+        #every other variable must still have a value >= target
+        others_bad = self.n_bad - (1 if self.hi[i] < self.target else 0)
+        return val >= self.target and others_bad == 0
+
+class MaxConstraint(BoundsConstraint):
+    '''max(scope) <= target, i.e. every variable takes a value <= target'''
+
+    def check(self, vals):
+        return max(vals) <= self.target
+
+    def update_bounds(self):
+        self.n_bad = sum(1 for lo in self.lo if lo > self.target)
+
+    def is_supported(self, i, val):
+        #every other variable must still have a value <= target
+        others_bad = self.n_bad - (1 if self.lo[i] > self.target else 0)
+        return val <= self.target and others_bad == 0
+
+def strongly_connected_components(succ):
+    '''Iterative Tarjan. succ[u] lists the successors of node u; return
+       a list giving the component number of each node'''
+    n = len(succ)
+    index = [None] * n
+    low = [0] * n
+    comp = [None] * n
+    on_stack = [False] * n
+    stack = []
+    counter = 0
+    n_comps = 0
+    for root in range(n):
+        if index[root] is not None:
+            continue
+        work = [(root, 0)]
+        while work:
+            u, i = work.pop()
+            if i == 0:
+                index[u] = low[u] = counter
+                counter += 1
+                stack.append(u)
+                on_stack[u] = True
+            recurse = False
+            while i < len(succ[u]):
+                w = succ[u][i]
+                i += 1
+                if index[w] is None:
+                    work.append((u, i))
+                    work.append((w, 0))
+                    recurse = True
+                    break
+                elif on_stack[w]:
+                    low[u] = min(low[u], index[w])
+            if recurse:
+                continue
+            if low[u] == index[u]:
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    comp[w] = n_comps
+                    if w == u:
+                        break
+                n_comps += 1
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[u])
+    return comp
+
 class CSP:
     '''Class for packing up a set of variables into a CSP problem.
        Contains various utility routines for accessing the problem.
@@ -325,8 +1391,10 @@ class CSP:
 
     def add_constraint(self, c):
         '''Add constraint to CSP. Note that all variables in the 
-           constraints scope must already have been added to the CSP'''
-        if not type(c) is Constraint:
+           constraints scope must already have been added to the CSP.
+           From then on the scope variables keep the constraint's
+           unassigned counters up to date (see Constraint.watch).'''
+        if not isinstance(c, Constraint):
             print("Trying to add non constraint ", c, " to CSP object")
         else:
             for v in c.scope:
@@ -335,6 +1403,7 @@ class CSP:
                     return
                 self.vars_to_cons[v].append(c)
             self.cons.append(c)
+            c.watch()
 
     def get_all_cons(self):
         '''return list of all constraints in the CSP'''
@@ -352,6 +1421,49 @@ class CSP:
         '''return list of unassigned variables in the CSP'''
         return [v for v in self.vars if not v.is_assigned()]
 
+    def compact(self):
+        '''Return the CSP in a compact, picklable form, for example to
+           send it to another process: plain lists of variable names and
+           domains, the codes of each distinct TupleTable (once, however
+           many constraints share it), and for each constraint its class,
+           name, scope (as variable numbers) and compact_args. Current
+           domains and assignments are not included. Rebuild the CSP
+           with CSP.from_compact.'''
+        var_index = dict()
+        for i, v in enumerate(self.vars):
+            var_index[v] = i
+        tables = []
+        table_index = dict()
+
+        def table_id(table):
+            if table is None:
+                return None
+            i = table_index.get(id(table))
+            if i is None:
+                i = len(tables)
+                table_index[id(table)] = i
+                tables.append((table.domains, table.codes))
+            return i
+
+        vars = [(v.name, v.domain()) for v in self.vars]
+        cons = []
+        for c in self.cons:
+            cons.append((type(c), c.name, [var_index[v] for v in c.scope],
+                         c.compact_args(table_id)))
+        return (self.name, vars, tables, cons)
+
+    @staticmethod
+    def from_compact(compact):
+        '''Rebuild a CSP from the output of CSP.compact'''
+        name, vars, tables, cons = compact
+        vars = [Variable(vname, dom) for vname, dom in vars]
+        tables = [TupleTable.from_codes(doms, codes) for doms, codes in tables]
+        csp = CSP(name, vars)
+        for kind, cname, scope, args in cons:
+            csp.add_constraint(kind.from_compact(cname, [vars[i] for i in scope],
+                                                 args, tables))
+        return csp
+
     def print_all(self):
         print("CSP", self.name)
         print("   Variables = ", self.vars)
@@ -364,6 +1476,189 @@ class CSP:
             print(v, " = ", v.get_assigned_value(), "    ", end='')
         print("")
 
+########################################################
+# Propagation Queue                                    #
+########################################################
+
+class ConstraintQueue:
+    '''Worklist of constraints waiting to be revised by a propagator.
+
+       A constraint is held at most once: pushing a constraint that is
+       already queued does nothing, so the queue never holds more than
+       the number of constraints in the CSP. Constraints are popped in
+       order of c.priority() (cheap ones first) and FIFO within the same
+       priority. push and pop are O(1) apart from the (few) distinct
+       priority levels kept in a heap.'''
+
+    def __init__(self, cons=[]):
+        self.buckets = dict()   #priority --> deque of queued constraints
+        self.levels = []        #heap of priorities with a non-empty bucket
+        self.queued = set()     #constraints currently in the queue
+        for c in cons:
+            self.push(c)
+
+    def push(self, c):
+        '''Add c to the queue unless it is already waiting'''
+        if c in self.queued:
+            return
+        self.queued.add(c)
+        p = c.priority()
+        bucket = self.buckets.get(p)
+        if bucket is None:
+            bucket = deque()
+            self.buckets[p] = bucket
+        if not bucket:
+            heapq.heappush(self.levels, p)
+        bucket.append(c)
+
+    def pop(self):
+        '''Remove and return the first constraint of the lowest priority'''
+        p = self.levels[0]
+        bucket = self.buckets[p]
+        c = bucket.popleft()
+        if not bucket:
+            heapq.heappop(self.levels)
+        self.queued.discard(c)
+        return c
+
+    def __len__(self):
+        return len(self.queued)
+
+########################################################
+# Trail                                                #
+########################################################
+
+class Trail:
+    '''Undo stack for the search state changed during propagation.
+
+       Every object whose state is trailed (e.g., a Variable's current
+       domain) pushes (object, old_state) before changing that state.
+       A search level takes a mark() before propagating and calls
+       undo_to(mark) to put every change made since then back in one
+       bulk operation, most recent change first. The object must
+       provide restore_state(old_state).
+
+       Other state than domains (e.g., the valid tuples of a
+       CompactTableConstraint) is trailed too, so the number of entries
+       is not the number of values pruned: that is counted separately,
+       in 'prunings', by Variable.prune_value.'''
+
+    def __init__(self):
+        self.entries = []
+        self.prunings = 0   #number of values pruned while attached (never undone)
+
+    def mark(self):
+        '''Return a checkpoint that can later be passed to undo_to'''
+        return len(self.entries)
+
+    def push(self, obj, state):
+        '''Record that obj was in state before the change about to be made'''
+        self.entries.append((obj, state))
+
+    def undo_to(self, mark):
+        '''Restore every change recorded since mark was taken'''
+        entries = self.entries
+        for i in range(len(entries) - 1, mark - 1, -1):
+            obj, state = entries[i]
+            obj.restore_state(state)
+        del entries[mark:]
+
+    def attach(self, vars):
+        '''Have vars record their domain changes on this trail'''
+        for v in vars:
+            v.trail = self
+
+    def detach(self, vars):
+        for v in vars:
+            v.trail = None
+
+########################################################
+# Restart policies                                     #
+########################################################
+
+class Luby:
+    '''Restart policy: the i-th run of bt_search may fail at most
+       scale * luby(i) times, where luby is the sequence
+       1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8, ...
+       Cutoffs grow without bound, so search stays complete.'''
+
+    def __init__(self, scale=32):
+        self.scale = scale
+
+    def cutoffs(self):
+        u, v = 1, 1
+        while True:
+            yield self.scale * v
+            #Knuth's reluctant doubling
+            if u & -u == v:
+                u, v = u + 1, 1
+            else:
+                v = 2 * v
+
+class Geometric:
+    '''Restart policy: the i-th run of bt_search may fail at most
+       base * factor**i times.'''
+
+    def __init__(self, base=32, factor=1.5):
+        self.base = base
+        self.factor = factor
+
+    def cutoffs(self):
+        cutoff = self.base
+        while True:
+            yield int(cutoff)
+            cutoff = cutoff * self.factor
+
+########################################################
+# Search limits                                        #
+########################################################
+
+#status returned by bt_search
+SOLVED = "solved"
+UNSAT = "unsat"
+LIMIT = "limit"
+
+class Limits:
+    '''Resource limits for bt_search and bt_solutions; a limit left at
+       None is not enforced.
+
+       cpu, wall == seconds of CPU or wall clock time since the search began
+       decisions == number of variable assignments
+       failures == number of dead ends
+       memory == megabytes of peak memory use of the process
+
+       The counters are checked at every decision, the clocks and the
+       memory use only every check_every decisions, so that checking
+       costs next to nothing.'''
+
+    def __init__(self, cpu=None, wall=None, decisions=None, failures=None,
+                 memory=None, check_every=16):
+        self.cpu = cpu
+        self.wall = wall
+        self.decisions = decisions
+        self.failures = failures
+        self.memory = memory
+        self.check_every = check_every
+
+    def reached(self, solver):
+        '''Return the name of a limit solver has reached, None if none'''
+        if self.decisions is not None and solver.nDecisions >= self.decisions:
+            return "decisions"
+        if self.failures is not None and solver.nFailures >= self.failures:
+            return "failures"
+        if solver.nDecisions % self.check_every:
+            return None
+        if self.cpu is not None and time.process_time() - solver.clock[1] >= self.cpu:
+            return "cpu"
+        if self.wall is not None and time.perf_counter() - solver.clock[0] >= self.wall:
+            return "wall"
+        if self.memory is not None and resource is not None:
+            #ru_maxrss is in kilobytes on Linux, in bytes on macOS
+            unit = 1 if sys.platform == "darwin" else 1024
+            if resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit >= self.memory * 2 ** 20:
+                return "memory"
+        return None
+
 ########################################################
 # Backtracking Routine                                 #
 ########################################################
@@ -384,7 +1679,29 @@ class BT:
         self.nDecisions = 0 #nDecisions is the number of variable 
                             #assignments made during search
         self.nPrunings  = 0 #nPrunings is the number of value prunings during search
+        self.nFailures  = 0 #nFailures is the number of dead ends met during search
+        self.nRestarts  = 0 #nRestarts is the number of restarts (see bt_search)
+        self.nNogoods   = 0 #nNogoods is the number of nogoods recorded at restarts
+        self.nBackjumps = 0 #nBackjumps is the number of backjumps (backjump mode)
+        self.nSkipped   = 0 #nSkipped is the number of levels the backjumps skipped
+        self.nSolutions = 0 #nSolutions is the number of solutions found
+        self.nSacPrunings = 0   #nSacPrunings is the number of values pruned by singleton_ac
+        self.nPropCalls = 0 #nPropCalls is the number of propagator calls
+        self.maxDepth   = 0 #maxDepth is the deepest search level reached
+        self.propWall   = 0 #wall clock and CPU seconds spent in the propagator
+        self.propCpu    = 0
+        self.clock = [0, 0, 0, 0]   #wall/CPU time of the start and end of the search
+        self.timers = None  #propagator name --> [calls, wall, CPU], see timers_on
+        self.callbacks = dict() #event --> functions, see add_callback
+        self.limits = None  #Limits of the current search
+        self.limitReached = None    #name of the limit that stopped the search
+        self.best = []      #(var, val) of the deepest consistent branch reached (with limits)
+        self.bestValid = 0  #number of levels of the current branch that best still matches
         unasgn_vars = list() #used to track unassigned variables
+        self.trail = Trail() #undo stack for domain changes made during search
+        self.stack = []     #choice points of bt_iterate
+        self.nogoods = dict()
+        self.root_nogoods = []
         self.TRACE = False
         self.runtime = 0
 
@@ -396,16 +1713,151 @@ class BT:
         '''Turn search trace off'''
         self.TRACE = False
 
+    def timers_on(self):
+        '''Time every propagator call, to split the search time between
+           propagation and the rest and to time every propagator
+           separately (see get_stats)'''
+        self.timers = dict()
+
+    def timers_off(self):
+        self.timers = None
+
+    def add_callback(self, event, fn):
+        '''Call fn(solver, ...) at every event of the search:
+             "node"      fn(solver, var, val)   var was assigned val
+             "failure"   fn(solver, var, val)   propagation after var=val failed
+             "solution"  fn(solver)             all variables are assigned
+             "backjump"  fn(solver, level, target)   levels in between skipped
+             "restart"   fn(solver, restarts)
+           '''
+        self.callbacks.setdefault(event, []).append(fn)
+
+    def emit(self, event, *args):
+        for fn in self.callbacks.get(event, ()):
+            fn(self, *args)
+
         
     def clear_stats(self):
         '''Initialize counters'''
         self.nDecisions = 0
         self.nPrunings = 0
+        self.nFailures = 0
+        self.nRestarts = 0
+        self.nNogoods = 0
+        self.nBackjumps = 0
+        self.nSkipped = 0
+        self.nSolutions = 0
+        self.nSacPrunings = 0
+        self.nPropCalls = 0
+        self.maxDepth = 0
+        self.propWall = 0
+        self.propCpu = 0
+        if self.timers is not None:
+            self.timers = dict()
+        for c in self.csp.cons:
+            c.revisions = 0
+            c.checks = 0
         self.runtime = 0
 
+    def start_clock(self):
+        self.clock = [time.perf_counter(), time.process_time()] * 2
+
+    def stop_clock(self):
+        self.clock[2:] = [time.perf_counter(), time.process_time()]
+
+    def get_stats(self):
+        '''Return the statistics of the last search as a dict (of
+           numbers, strings, lists and dicts only, see stats_json):
+           counters, the time of the search and, if timers_on was called,
+           its split between propagation and the rest of the search
+           (None otherwise) and the propagator timers, and
+           for every constraint its revisions, checks and weight,
+           constraints with the most checks first.'''
+        wall = self.clock[2] - self.clock[0]
+        cpu = self.clock[3] - self.clock[1]
+        stats = {
+            "csp": self.csp.name,
+            "nodes": self.nDecisions,
+            "failures": self.nFailures,
+            "prunings": self.nPrunings,
+            "max_depth": self.maxDepth,
+            "solutions": self.nSolutions,
+            "sac_prunings": self.nSacPrunings,
+            "propagator_calls": self.nPropCalls,
+            "restarts": self.nRestarts,
+            "nogoods": self.nNogoods,
+            "backjumps": self.nBackjumps,
+            "levels_skipped": self.nSkipped,
+            "limit": self.limitReached,
+            "time": {
+                "wall": wall,
+                "cpu": cpu,
+                "propagation_wall": None,
+                "propagation_cpu": None,
+                "search_wall": None,
+                "search_cpu": None,
+            },
+        }
+        if self.timers is not None:
+            stats["time"].update({
+                "propagation_wall": self.propWall,
+                "propagation_cpu": self.propCpu,
+                "search_wall": wall - self.propWall,
+                "search_cpu": cpu - self.propCpu,
+            })
+            stats["timers"] = dict([(name, {"calls": calls, "wall": w, "cpu": c})
+                                    for name, (calls, w, c) in self.timers.items()])
+        cons = []
+        for c in self.csp.cons:
+            cons.append({"name": c.name, "revisions": c.revisions,
+                         "checks": c.checks, "weight": c.weight})
+        cons.sort(key=lambda d: -d["checks"])
+        stats["constraints"] = cons
+        return stats
+
+    def stats_json(self, **kwargs):
+        '''get_stats as a JSON string; kwargs are passed to json.dumps'''
+        return json.dumps(self.get_stats(), **kwargs)
+
+    def propagate(self, propagator, var=None):
+        '''Call propagator(csp, var) (propagator(csp) if var is None) and
+           return its result. The call is only timed after timers_on:
+           reading the clocks costs about as much as a cheap propagator
+           call.'''
+        self.nPropCalls = self.nPropCalls + 1
+        if self.timers is None:
+            if var is None:
+                return propagator(self.csp)
+            return propagator(self.csp, var)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if var is None:
+            result = propagator(self.csp)
+        else:
+            result = propagator(self.csp, var)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        self.propWall = self.propWall + wall
+        self.propCpu = self.propCpu + cpu
+        name = getattr(propagator, "__name__", str(propagator))
+        timer = self.timers.setdefault(name, [0, 0, 0])
+        timer[0] = timer[0] + 1
+        timer[1] = timer[1] + wall
+        timer[2] = timer[2] + cpu
+        return result
+
     def print_stats(self):
         print("Search made {} variable assignments and pruned {} variable values".format(
             self.nDecisions, self.nPrunings))
+        if self.nRestarts:
+            print("Search restarted {} times and recorded {} nogoods".format(
+                self.nRestarts, self.nNogoods))
+        if self.nSacPrunings:
+            print("Singleton arc consistency pruned {} values before search".format(
+                self.nSacPrunings))
+        if self.nBackjumps:
+            print("Search backjumped {} times, skipping {} levels".format(
+                self.nBackjumps, self.nSkipped))
 
     def restoreValues(self,prunings):
         '''Restore list of values to variable domains
@@ -424,7 +1876,8 @@ class BT:
         '''Add variable back to list of unassigned vars'''
         self.unasgn_vars.append(var)
         
-    def bt_search(self,propagator,var_ord=None,val_ord=None):
+    def bt_search(self,propagator,var_ord=None,val_ord=None,restarts=None,seed=None,
+                  backjump=False,limits=None,sac=None):
         '''Try to solve the CSP using specified propagator routine
 
            propagator == a function with the following template
@@ -450,101 +1903,567 @@ class BT:
 
            The list of variable values pairs are all of the values
            the propagator pruned (using the variable's prune_value method). 
-           bt_search NEEDS to know this in order to correctly restore these 
-           values when it undoes a variable assignment.
+           bt_search does NOT use this list to undo a variable assignment:
+           while searching every prune_value is recorded on the solver's
+           trail, and each search level restores back to the trail mark it
+           took before propagating. So a propagator may return an empty
+           list; the list is only shown in the search trace.
 
            NOTE propagator SHOULD NOT prune a value that has already been 
            pruned! Nor should it prune a value twice
 
            var_ord is the variable ordering function currently being used; 
            val_ord is the value ordering function currently being used.
+
+           restarts is an optional restart policy (Luby or Geometric).
+           With a policy the search is split into runs: a run is
+           abandoned once it has met as many dead ends as the policy's
+           next cutoff, and the search starts again from the root. Before
+           restarting, every value refuted on the abandoned branch is
+           recorded as a nogood (see record_nogoods), so later runs never
+           enter a subtree that has already been refuted, and ties in the
+           variable ordering are broken randomly (seed seeds the random
+           generator) so that each run explores a different branch.
+
+           backjump == True turns on conflict-directed backjumping: when
+           every value of a variable has failed, search goes straight
+           back to the deepest earlier assignment that took part in one
+           of the failures (see conflict_levels), instead of always to
+           the previous level. It is meant for prop_BT and prop_FC; with
+           other propagators it is still correct, but the conflicts it
+           finds are less precise.
+
+           limits is an optional Limits object: the search stops as soon
+           as one of its limits is reached.
+
+           sac is an optional propagator (normally prop_GAC): before the
+           search starts, singleton_ac prunes every value that this
+           propagator refutes when it is tried on its own (see
+           singleton_ac). The pruned values stay out of the domains for
+           the whole search.
+
+           Returns (status, stats, assignment): status is SOLVED, UNSAT
+           or LIMIT (a limit was reached first), stats is get_stats()
+           and assignment maps Variables to values: the solution if
+           status is SOLVED, and if it is LIMIT the deepest partial
+           assignment the propagator accepted during the search. When a
+           limit is reached the variables are left unassigned.
            '''
 
-        self.clear_stats()
         stime = time.process_time()
-
-        self.restore_all_variable_domains()
-        
-        self.unasgn_vars = []
-        for v in self.csp.vars:
-            if not v.is_assigned():
-                self.unasgn_vars.append(v)
-
-        status, prunings = propagator(self.csp) #initial propagate no assigned variables.
-        self.nPrunings = self.nPrunings + len(prunings)
-
-        if self.TRACE:
-            print(len(self.unasgn_vars), " unassigned variables at start of search")
-            print("Root Prunings: ", prunings)
+        status = self.bt_start(propagator, limits, sac)
 
         if status == False:
             print("CSP{} detected contradiction at root".format(
                 self.csp.name))
+        elif restarts is None:
+            status = self.bt_iterate(propagator, var_ord, val_ord, None, backjump)   #now do the search
         else:
-            status = self.bt_recurse(propagator, var_ord, val_ord, 1)   #now do recursive search
-
-        self.restoreValues(prunings)
+            status = self.bt_restarts(propagator, var_ord, val_ord, restarts, seed, backjump)
+
+        self.stop_clock()
+        self.detach_listeners()
+        if status is None:
+            self.unwind(0)
+        self.trail.undo_to(0)
+        self.trail.detach(self.csp.vars)
         if status == False:
             print("CSP{} unsolved. Has no solutions".format(self.csp.name))
+            result = UNSAT, dict()
         if status == True:
             print("CSP {} solved. CPU Time used = {}".format(self.csp.name,
                                                              time.process_time() - stime))
             self.csp.print_soln()
+            result = SOLVED, dict([(var, var.get_assigned_value()) for var in self.csp.vars])
+        if status is None:
+            print("CSP {} search stopped: {} limit reached".format(self.csp.name,
+                                                                 self.limitReached))
+            result = LIMIT, dict(self.best)
 
         print("bt_search finished")
         self.print_stats()
+        return result[0], self.get_stats(), result[1]
+
+    def bt_solutions(self, propagator, var_ord=None, val_ord=None, limit=None,
+                     backjump=False, limits=None, sac=None):
+        '''Generator version of bt_search: yield the solutions of the CSP
+           one at a time, each as a dict mapping every Variable to its
+           value, e.g., for a warehouse model
+
+               for soln in BT(csp).bt_solutions(prop_GAC):
+                   print(soln[var_array[0][0]])
+
+           propagator, var_ord, val_ord, backjump, limits and sac are as
+           for bt_search. At most limit solutions are produced (all of
+           them if limit is None); if one of the limits is reached no
+           more are produced, and self.limitReached tells which. Nothing
+           is printed: the search is suspended at each yield and resumes
+           from that point when the next solution is asked for, and the
+           statistics keep counting over the solutions found so far.
+           When the generator is exhausted or closed, the variables are
+           left unassigned with their domains restored.'''
+
+        if limit is not None and limit <= 0:
+            return
+        status = self.bt_start(propagator, limits, sac)
+        try:
+            count = 0
+            resume = False
+            while status:
+                status = self.bt_iterate(propagator, var_ord, val_ord, None,
+                                         backjump, resume)
+                if status:
+                    self.stop_clock()
+                    yield dict([(var, var.get_assigned_value()) for var in self.csp.vars])
+                    count = count + 1
+                    if limit is not None and count >= limit:
+                        break
+                    resume = True
+        finally:
+            self.stop_clock()
+            self.detach_listeners()
+            self.unwind(0)
+            self.trail.undo_to(0)
+            self.trail.detach(self.csp.vars)
+
+    def detach_listeners(self):
+        '''Stop the variables from notifying the variable ordering of
+           the search that just ended (e.g., heuristics.MRV registers
+           itself as their listener; it registers again when it is used
+           by another search)'''
+        for var in self.csp.vars:
+            var.listener = None
+
+    def bt_start(self, propagator, limits=None, sac=None):
+        '''Reset the statistics, the variables and the trail, then run
+           the propagator before any assignment (and singleton_ac with
+           the propagator sac, if not None). Return its status.'''
+
+        self.clear_stats()
+        self.start_clock()
+        self.limits = limits
+        self.limitReached = None
+        self.best = []
+        self.bestValid = 0
+
+        self.restore_all_variable_domains()
+        self.trail = Trail()
+        self.trail.attach(self.csp.vars)
+        self.stack = []
+        self.nogoods = dict()       #(var, val) --> nogoods with var=val in their prefix
+        self.root_nogoods = []      #values refuted with no assignment at all
+        
+        self.unasgn_vars = []
+        for v in self.csp.vars:
+            if not v.is_assigned():
+                self.unasgn_vars.append(v)
 
-    def bt_recurse(self, propagator, var_ord, val_ord, level):
-        '''Return true if found solution. False if still need to search.
-           If top level returns false--> no solution'''
+        status, prunings = self.propagate(propagator) #initial propagate no assigned variables.
+        self.nPrunings = self.nPrunings + self.trail.prunings
+        if status and sac is not None:
+            status = self.singleton_ac(sac)
 
         if self.TRACE:
-            print('  ' * level, "bt_recurse level ", level)
-           
-        if not self.unasgn_vars:
-            #all variables assigned
-            return True
-        else:
-            ##Figure out which variable to assign,
-            ##Then remove it from the list of unassigned vars
-            if var_ord:
-              var = var_ord(self.csp)
-            else:
-              var = self.unasgn_vars[0]
-            self.unasgn_vars.remove(var) 
+            print(len(self.unasgn_vars), " unassigned variables at start of search")
+            print("Root Prunings: ", prunings)
+            if sac is not None:
+                print("Singleton AC Prunings: ", self.nSacPrunings)
+        return status
+
+    def singleton_ac(self, propagator):
+        '''Make the unassigned variables singleton arc consistent with
+           respect to propagator, before any assignment is made.
+
+           Each value val of each variable var is tried on its own: var is
+           assigned val and the propagator is run, then everything is
+           undone back to the trail mark taken before, as a search level
+           would. If the propagator fails, val cannot be part of any
+           solution, so it is pruned (on the trail, so bt_search restores
+           it when the search ends) and the propagator is run again from
+           var to pass the pruning on. Since a pruning can make values
+           tried before fail, the variables are tried again until a whole
+           pass prunes nothing.
+
+           Return False if the domain of some variable becomes empty (the
+           CSP has no solution), True otherwise.'''
+
+        changed = True
+        while changed:
+            changed = False
+            for var in self.unasgn_vars:
+                for val in var.cur_domain():
+                    if not var.in_cur_domain(val):
+                        #pruned by the propagation after an earlier value
+                        continue
+                    mark = self.trail.mark()
+                    var.assign(val)
+                    status, _ = self.propagate(propagator, var)
+                    self.trail.undo_to(mark)
+                    var.unassign()
+                    if status:
+                        continue
+
+                    if self.TRACE:
+                        print("  singleton_ac pruned", var, "=", val)
+                    #prunings of the tentative assignments are not counted
+                    before = self.trail.prunings
+                    var.prune_value(val)
+                    self.nSacPrunings = self.nSacPrunings + 1
+                    changed = True
+                    if var.cur_domain_size() == 0:
+                        self.nPrunings = self.nPrunings + 1
+                        return False
+                    status, _ = self.propagate(propagator, var)
+                    self.nPrunings = self.nPrunings + self.trail.prunings - before
+                    if not status:
+                        return False
+        return True
 
+    def bt_restarts(self, propagator, var_ord, val_ord, restarts, seed, backjump=False):
+        '''Run bt_iterate under the cutoffs of the restart policy.
+           Return true if found solution, false if there is none.'''
+
+        rng = random.Random(seed)
+        for cutoff in restarts.cutoffs():
+            root = self.trail.mark()
+            before = self.trail.prunings
+            for var, val in self.root_nogoods:
+                if var.in_cur_domain(val):
+                    var.prune_value(val)
+                    if var.cur_domain_size() == 0:
+                        self.trail.undo_to(root)
+                        return False
+            self.nPrunings = self.nPrunings + self.trail.prunings - before
+
+            status = self.bt_iterate(propagator, var_ord, val_ord, cutoff, backjump)
+            if status is not None or self.limitReached:
+                return status
+
+            #cutoff reached: learn from the branch, then back to the root
+            self.record_nogoods()
+            self.unwind(0)
+            self.trail.undo_to(root)
+            self.nRestarts = self.nRestarts + 1
+            if self.callbacks:
+                self.emit("restart", self.nRestarts)
             if self.TRACE:
-                print('  ' * level, "bt_recurse var = ", var)
-
-            if val_ord:
-              value_order = val_ord(self.csp, var)
+                print("Restart", self.nRestarts, "after", cutoff, "failures")
+
+            rng.shuffle(self.unasgn_vars)
+            if var_ord is not None and hasattr(var_ord, "randomize"):
+                var_ord.randomize(rng)
+
+    def record_nogoods(self):
+        '''Record the refutations of the current branch of bt_iterate.
+
+           If the branch assigned x1=a1, ..., xk=ak (in that order) then
+           every value b of x(i) tried before a(i) was refuted under
+           x1=a1, ..., x(i-1)=a(i-1). So that prefix together with x(i)=b
+           is a nogood: once the prefix is assigned, b can be pruned
+           from x(i). bt_iterate stops right after a dead end, so at the
+           deepest choice point the value tried last is refuted too.'''
+
+        prefix = []
+        last = len(self.stack) - 1
+        for depth, frame in enumerate(self.stack):
+            var, value_order, i = frame[:3]
+            tried = i if depth == last else i - 1
+            for val in value_order[:tried]:
+                self.nNogoods = self.nNogoods + 1
+                if not prefix:
+                    self.root_nogoods.append((var, val))
+                    continue
+                nogood = (tuple(prefix), var, val)
+                for lit in prefix:
+                    self.nogoods.setdefault(lit, []).append(nogood)
+            prefix.append((var, value_order[i - 1]))
+
+    def split_off(self):
+        '''Give away part of the search of bt_iterate: remove the untried
+           values of the shallowest choice point that still has some,
+           and return them as decision prefixes, i.e., lists
+           [(var, val), ...] of the assignments leading to each of them.
+           Return [] if every choice point is on its last value.'''
+
+        prefix = []
+        for frame in self.stack:
+            var, value_order, i = frame[:3]
+            if i < len(value_order):
+                frame[1] = value_order[:i]
+                return [prefix + [(var, val)] for val in value_order[i:]]
+            prefix.append((var, value_order[i - 1]))
+        return []
+
+    def apply_nogoods(self, var, val):
+        '''Prune the values forbidden by the nogoods whose prefix became
+           fully assigned when var was assigned val. Return False if a
+           nogood is violated or empties a domain.'''
+
+        for prefix, x, b in self.nogoods.get((var, val), ()):
+            for y, a in prefix:
+                if y.get_assigned_value() != a:
+                    break
             else:
-              value_order = var.cur_domain()
+                if x.is_assigned():
+                    if x.get_assigned_value() == b:
+                        return False
+                elif x.in_cur_domain(b):
+                    x.prune_value(b)
+                    if x.cur_domain_size() == 0:
+                        return False
+        return True
 
-            for val in value_order:
+    def unwind(self, level):
+        '''Undo the choice points of bt_iterate above level'''
+        while len(self.stack) > level:
+            var, mark = self.stack[-1][0], self.stack[-1][3]
+            if mark is not None:
+                self.trail.undo_to(mark)
+                var.unassign()
+            self.stack.pop()
+            self.restoreUnasgnVar(var)
 
+    def assigned_levels(self):
+        '''Return (level of each assigned variable, trail mark of each
+           level); level i is the i-th choice point of bt_iterate'''
+        level_of = dict()
+        marks = []
+        for frame in self.stack:
+            if frame[3] is None:
+                break
+            marks.append(frame[3])
+            level_of[frame[0]] = len(marks)
+        return level_of, marks
+
+    def conflict_levels(self, var, level):
+        '''Return the set of earlier levels whose assignments took part
+           in the dead end just met after assigning var at level.
+
+           If the propagator emptied the domain of some variable x (as
+           prop_FC does), those are the levels that pruned the values
+           of x. Otherwise (prop_BT) they are the levels of the other
+           variables of a constraint on var that is now violated.'''
+
+        level_of, marks = self.assigned_levels()
+        for x in self.csp.vars:
+            if x.curdom == 0 and not x.is_assigned():
+                conf = self.explain(x, level_of, marks)
+                conf.discard(level)
+                return conf
+
+        best = None
+        for c in self.csp.get_cons_with_var(var):
+            if c.get_n_unasgn() == 0:
+                scope = c.get_scope()
+                if not c.check([y.get_assigned_value() for y in scope]):
+                    levels = set([level_of[y] for y in scope if y is not var])
+                    if best is None or max(levels, default=0) < max(best, default=0):
+                        best = levels
+        if best is None:
+            #the dead end cannot be explained, so blame every level
+            return set(range(1, level))
+        return best
+
+    def explain(self, x, level_of, marks):
+        '''Return the set of levels that are responsible for the values
+           pruned from the current domain of x.
+
+           The trail tells at which level each value was pruned (values
+           pruned before the first level are pruned for good). A value
+           val pruned at level j is blamed on the levels of the other
+           variables of a constraint over x that those variables,
+           assigned at level j or earlier, leave no room for x=val in.
+           If there is no such constraint (e.g., the value was pruned by
+           GAC reasoning) it is blamed on every level up to j.'''
+
+        conf = set()
+        if not marks:
+            return conf
+        entries = self.trail.entries
+        times = [t for t in range(marks[0], len(entries)) if entries[t][0] is x]
+        for n, t in enumerate(times):
+            after = entries[times[n + 1]][1] if n + 1 < len(times) else x.curdom
+            removed = entries[t][1] & ~after
+            j = bisect.bisect_right(marks, t)
+            while removed:
+                low = removed & -removed
+                removed ^= low
+                val = x.dom[low.bit_length() - 1]
+                best = None
+                for c in self.csp.get_cons_with_var(x):
+                    vals = []
+                    levels = set()
+                    for y in c.get_scope():
+                        if y is x:
+                            vals.append(val)
+                            continue
+                        l = level_of.get(y)
+                        if l is None or l > j:
+                            break
+                        vals.append(y.get_assigned_value())
+                        levels.add(l)
+                    else:
+                        if not c.check(vals) and (best is None or 
+                                max(levels, default=0) < max(best, default=0)):
+                            best = levels
+                if best is None:
+                    conf.update(range(1, j + 1))
+                else:
+                    conf.update(best)
+        return conf
+
+    def bt_iterate(self, propagator, var_ord, val_ord, cutoff=None, backjump=False,
+                   resume=False):
+        '''Return true if found solution, false if there is none, and
+           None if cutoff dead ends were met first (the current branch
+           is then left assigned, in self.stack, for bt_restarts) or
+           if one of self.limits was reached (self.limitReached is then
+           set).
+           With resume == True the search carries on from the solution
+           found by the previous call, looking for the next one.
+
+           Same search as the textbook recursive backtracking (one level
+           per assigned variable, values tried in order) but driven by an
+           explicit stack of choice points, so the number of variables is
+           not bounded by Python's recursion limit. Each choice point is
+           [var, value_order, index of next value, trail mark, prunings,
+           conflict set]; the trail mark is None while no value of var is
+           assigned. The conflict set (backjump mode only) collects the
+           earlier levels blamed for the failures of var's values.'''
+
+        if resume:
+            stack = self.stack
+            if not stack:
+                return False
+            if backjump:
+                #no level may be jumped over once a solution lies below it
+                for level, frame in enumerate(stack):
+                    frame[5].update(range(1, level + 1))
+        else:
+            stack = self.stack = []
+        if cutoff is not None:
+            cutoff = self.nFailures + cutoff
+        descend = not resume    #False when backtracking into the top choice point
+        while True:
+            if descend:
+                level = len(stack) + 1
                 if self.TRACE:
-                    print('  ' * level, "bt_recurse trying", var, "=", val)
+                    print('  ' * level, "bt_iterate level ", level)
 
-                var.assign(val)
-                self.nDecisions = self.nDecisions + 1
+                if not self.unasgn_vars:
+                    #all variables assigned
+                    self.nSolutions = self.nSolutions + 1
+                    if self.callbacks:
+                        self.emit("solution")
+                    return True
 
-                status, prunings = propagator(self.csp, var)
-                self.nPrunings = self.nPrunings + len(prunings)
+                ##Figure out which variable to assign,
+                ##Then remove it from the list of unassigned vars
+                if var_ord:
+                  var = var_ord(self.csp)
+                else:
+                  var = self.unasgn_vars[0]
+                self.unasgn_vars.remove(var) 
 
                 if self.TRACE:
-                    print('  ' * level, "bt_recurse prop status = ", status)
-                    print('  ' * level, "bt_recurse prop pruned = ", prunings)
-
-                if status:
-                    if self.bt_recurse(propagator, var_ord, val_ord, level + 1):
-                        return True
-
+                    print('  ' * level, "bt_iterate var = ", var)
+
+                if val_ord:
+                  value_order = val_ord(self.csp, var)
+                else:
+                  value_order = var.cur_domain()
+                stack.append([var, value_order, 0, None, None,
+                              set() if backjump else None])
+                if level > self.maxDepth:
+                    self.maxDepth = level
+
+            frame = stack[-1]
+            var, value_order, i, mark, prunings = frame[:5]
+            level = len(stack)
+            if mark is not None:
+                #undo the previous value of var
                 if self.TRACE:
-                    print('  ' * level, "bt_recurse restoring ", prunings)
-                self.restoreValues(prunings)
+                    print('  ' * level, "bt_iterate restoring ", prunings)
+                self.trail.undo_to(mark)
                 var.unassign()
+                frame[3] = None
+
+            if i == len(value_order) and backjump:
+                #all values of var failed: jump back to the deepest level
+                #blamed for a failure or for a value pruned from var
+                conf = frame[5]
+                conf.update(self.explain(var, *self.assigned_levels()))
+                conf.discard(level)
+                if not conf:
+                    self.unwind(0)
+                    return False
+                target = max(conf)
+                conf.discard(target)
+                self.unwind(target)
+                stack[-1][5].update(conf)
+                if target < level - 1:
+                    self.nBackjumps = self.nBackjumps + 1
+                    self.nSkipped = self.nSkipped + level - 1 - target
+                    if self.callbacks:
+                        self.emit("backjump", level, target)
+                if self.TRACE:
+                    print('  ' * level, "bt_iterate backjump to level", target)
+                descend = False
+                continue
+
+            if i == len(value_order):
+                #all values of var failed: backtrack to the previous level
+                stack.pop()
+                self.restoreUnasgnVar(var)
+                if not stack:
+                    return False
+                descend = False
+                continue
+
+            if self.limits is not None:
+                self.limitReached = self.limits.reached(self)
+                if self.limitReached:
+                    return None
+
+            val = value_order[i]
+            frame[2] = i + 1
+            if level <= self.bestValid:
+                self.bestValid = level - 1
+            if self.TRACE:
+                print('  ' * level, "bt_iterate trying", var, "=", val)
+
+            var.assign(val)
+            self.nDecisions = self.nDecisions + 1
+            if self.callbacks:
+                self.emit("node", var, val)
+
+            mark = self.trail.mark()
+            frame[3] = mark
+            before = self.trail.prunings
+            if self.nogoods and not self.apply_nogoods(var, val):
+                status, prunings = False, []
+            else:
+                status, prunings = self.propagate(propagator, var)
+            self.nPrunings = self.nPrunings + self.trail.prunings - before
+            frame[4] = prunings
 
-            self.restoreUnasgnVar(var)
-            return False
-
+            if self.TRACE:
+                print('  ' * level, "bt_iterate prop status = ", status)
+                print('  ' * level, "bt_iterate prop pruned = ", prunings)
+
+            descend = status
+            if status and self.limits is not None and level > len(self.best):
+                #only needed for the result of a search stopped by a limit;
+                #copy just the levels that changed since the last copy
+                valid = self.bestValid
+                del self.best[valid:]
+                self.best.extend([(f[0], f[1][f[2] - 1]) for f in stack[valid:]])
+                self.bestValid = level
+            if not status:
+                if backjump:
+                    frame[5].update(self.conflict_levels(var, level))
+                self.nFailures = self.nFailures + 1
+                if self.callbacks:
+                    self.emit("failure", var, val)
+                if cutoff is not None and self.nFailures >= cutoff:
+                    return None
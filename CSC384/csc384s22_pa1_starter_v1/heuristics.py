@@ -0,0 +1,184 @@
+'''Variable and value ordering heuristics to be used within bt_search.
+
+A variable ordering is a callable with the template
+    var_ord(csp)
+        ==> returns the next unassigned Variable to assign
+
+The orderings in this file are objects, so that they can keep their
+scores between calls instead of rescanning every unassigned variable at
+every node. Make one and pass it to bt_search, e.g.,
+
+    solver = BT(csp)
+    solver.bt_search(prop_FC, var_ord=MRV())
+
+On the first call for a CSP an ordering registers itself as the
+'listener' of every variable of the CSP. Variables call their listener
+whenever their current domain, their assignment or the weight of one of
+their constraints changes, and the ordering then pushes the variable's
+new score on a heap. Stale heap entries are discarded lazily when they
+reach the top, so choosing a variable is O(log n) amortized.
+
+    1. MRV
+        - minimum remaining values: smallest current domain first.
+
+    2. DomDeg
+        - smallest current domain size / degree (the number of
+          constraints over the variable) first.
+
+    3. DomWDeg
+        - smallest current domain size / weighted degree first, where the
+          weighted degree adds up the weights of the variable's
+          constraints (see Constraint.bump_weight; propagators bump the
+          weight of a constraint each time it causes a dead end).
+
+Ties are broken by the order of the variables in the CSP, or by a
+random order of them after randomize(rng) (bt_search calls it when it
+restarts).
+
+A value ordering is a function with the template
+    val_ord(csp, var)
+        ==> returns the list of values of var's current domain to try, in order
+
+    4. val_lcv
+        - least constraining value: values with the most support in the
+          constraints over var first. Support counts come from each
+          constraint's support_count, whose cost depends on the kind of
+          constraint:
+            Compact-Table   popcount of the valid-tuple bitset the
+                            propagation already maintains
+            binary table    popcount of a cached bitmask of the other
+                            variable's supporting values
+            n-ary table     a scan of the supports of the value, at
+                            every call (nothing is kept between calls)
+            all-different   the number of other variables that would
+                            lose the value
+            function and    0, i.e. no preference, so on
+            bounds          warehouse_full_model only the row and
+                            column constraints order the values
+'''
+import heapq
+from cspbase import popcount
+
+class VarOrdering:
+    '''Base class for the incrementally maintained variable orderings.
+       Subclasses define score(var); the unassigned variable with the
+       lowest score is chosen.'''
+
+    def __init__(self):
+        self.csp = None
+        self.rank = None        #tie-break rank of each variable, None = CSP order
+        self.listener = self.var_changed    #keep one bound method, compared by identity
+
+    def score(self, var):
+        raise NotImplementedError
+
+    def __call__(self, csp):
+        if self.csp is not csp or not self.attached():
+            self.attach(csp)
+        heap = self.heap
+        while heap:
+            key, _, i, var = heap[0]
+            if key != self.keys[i]:
+                #stale entry, a newer one was pushed for var
+                heapq.heappop(heap)
+            elif var.is_assigned():
+                #var will be pushed again when it is unassigned
+                heapq.heappop(heap)
+                self.live[i] = False
+            else:
+                return var
+        return csp.get_all_unasgn_vars()[0]
+
+    def attached(self):
+        for var in self.csp.vars:
+            return var.listener is self.listener
+        return True
+
+    def attach(self, csp):
+        '''Register as the listener of the variables of csp and build the heap'''
+        self.csp = csp
+        self.index = dict()
+        for i, var in enumerate(csp.vars):
+            self.index[var] = i
+            var.listener = self.listener
+        self.rank = list(range(len(csp.vars)))
+        self.setup(csp)
+        self.rebuild()
+
+    def randomize(self, rng):
+        '''Break future ties in a random order drawn from rng'''
+        if self.csp is None:
+            return
+        rng.shuffle(self.rank)
+        self.rebuild()
+
+    def setup(self, csp):
+        '''Hook for subclasses, called before the heap is built'''
+        pass
+
+    def rebuild(self):
+        self.keys = [None] * len(self.csp.vars)
+        self.live = [False] * len(self.csp.vars)
+        self.heap = []
+        for i, var in enumerate(self.csp.vars):
+            self.keys[i] = self.score(var)
+            if not var.is_assigned():
+                self.heap.append((self.keys[i], self.rank[i], i, var))
+                self.live[i] = True
+        heapq.heapify(self.heap)
+
+    def var_changed(self, var):
+        '''Listener called by var after one of its changes'''
+        i = self.index.get(var)
+        if i is None:
+            return
+        key = self.score(var)
+        if key != self.keys[i] or not self.live[i]:
+            self.keys[i] = key
+            self.live[i] = True
+            heapq.heappush(self.heap, (key, self.rank[i], i, var))
+            if len(self.heap) > 4 * len(self.keys) + 64:
+                self.rebuild()
+
+class MRV(VarOrdering):
+    '''Minimum remaining values'''
+
+    def score(self, var):
+        return popcount_dom(var)
+
+class DomDeg(VarOrdering):
+    '''Current domain size over degree'''
+
+    def setup(self, csp):
+        self.degree = dict()
+        for var in csp.vars:
+            self.degree[var] = max(len(csp.vars_to_cons[var]), 1)
+
+    def score(self, var):
+        return popcount_dom(var) / self.degree[var]
+
+class DomWDeg(VarOrdering):
+    '''Current domain size over weighted degree'''
+
+    def score(self, var):
+        wdeg = 0
+        for c in self.csp.vars_to_cons[var]:
+            wdeg = wdeg + c.weight
+        return popcount_dom(var) / max(wdeg, 1)
+
+def popcount_dom(var):
+    '''Size of the CURRENT domain, ignoring any assignment (assigned
+       variables are never chosen, so their score does not matter)'''
+    return popcount(var.curdom)
+
+def val_lcv(csp, var):
+    '''Least constraining value ordering'''
+    cons = [c for c in csp.vars_to_cons[var] if c.get_n_unasgn() > 1]
+    scored = []
+    for val in var.cur_domain():
+        score = 0
+        for c in cons:
+            score = score + c.support_count(var, val)
+        scored.append((-score, len(scored), val))
+    scored.sort()
+    return [val for _, _, val in scored]
@@ -1,196 +1,363 @@
-#Look for #IMPLEMENT tags in this file.
-'''
-All models need to return a CSP object, and a list of lists of Variable objects 
-representing the board. The returned list of lists is used to access the 
-solution. 
-
-For example, after these three lines of code
-
-    csp, var_array = warehouse_binary_ne_grid(board)
-    solver = BT(csp)
-    solver.bt_search(prop_FC, var_ord)
-
-var_array[0][0].get_assigned_value() should be the correct value in the top left
-cell of the warehouse.
-
-The grid-only models do not need to encode the cage constraints.
-
-1. warehouse_binary_ne_grid
-    - A model of the warehouse problem w/o room constraints built using only 
-      binary not-equal constraints for the row/column constraints.
-
-2. warehouse_nary_ad_grid
-    - A model of the warehouse problem w/o room constraints built using only n-ary 
-      all-different constraints for the row/column constraints. 
-
-3. warehouse_full_model
-    - A model of the warehouse problem built using either the binary not-equal or n-ary
-      all-different constraints for the row/column constraints.
-'''
-from cspbase import *
-import itertools
-
-def warehouse_binary_ne_grid(warehouse_grid):
-    n = warehouse_grid[0][0]
-    domain = list(range(1, n + 1))
-    var_array = [[0 for _ in range(n)] for _ in range(n)]
-    vars = []
-    cons = []
-    sat_tuples = []
-
-    for t in itertools.product(domain, domain):
-        if t[0] != t[1]:
-            sat_tuples.append(t)
-
-    for i in range(1, len(warehouse_grid)):
-        building = warehouse_grid[i]
-        operation = building[len(building) - 2]
-        target_val = building[len(building) - 1]
-        for j in range(len(building) - 2):
-            col = building[j] // 10
-            row = building[j] % 10
-            var = Variable("R{}{}".format(col, row), domain)
-            vars.append(var)
-            var_array[(n + 1 - row) - 1][col - 1] = var
-
-    def build_row_col_constraints(i, j):
-        # Build constraint with every room in the same column
-        for k in range(j + 1, n):
-            c = Constraint("C(R{}{},R{}{})".format(i + 1, j + 1, i + 1, k + 1), [var_array[i][j], var_array[i][k]])
-            c.add_satisfying_tuples(sat_tuples)
-            cons.append(c)
-
-        # Build constraint with every room in the same row
-        for k in range(i + 1, n):
-            c = Constraint("C(R{}{},R{}{})".format(i + 1, j + 1, k + 1, j + 1), [var_array[i][j], var_array[k][j]])
-            c.add_satisfying_tuples(sat_tuples)
-            cons.append(c)
-
-    for i in range(n):
-        for j in range(n):
-            build_row_col_constraints(i, j)
-
-    csp = CSP("Warehouse-{}".format(n), vars)
-    for c in cons:
-        csp.add_constraint(c)
-
-    return csp, var_array
-
-def warehouse_nary_ad_grid(warehouse_grid):
-    n = warehouse_grid[0][0]
-    domain = list(range(1, n + 1))
-    domain_list = [domain for _ in range(n)]
-    var_array = [[0 for _ in range(n)] for _ in range(n)]
-    vars = []
-    cons = []
-    sat_tuples = []
-
-    for t in itertools.product(*domain_list):
-        if len(set(t)) == len(t):
-            sat_tuples.append(t)
-
-    for i in range(1, len(warehouse_grid)):
-        building = warehouse_grid[i]
-        operation = building[len(building) - 2]
-        target_val = building[len(building) - 1]
-        for j in range(len(building) - 2):
-            col = building[j] // 10
-            row = building[j] % 10
-            var = Variable("R{}{}".format(col, row), domain)
-            vars.append(var)
-            var_array[(n + 1 - row) - 1][col - 1] = var
-
-    def build_row_col_constraints(i):
-        # Build constraint with every room in the same column
-        c_col = Constraint("C(R-Col{})".format(i), [var_array[i][j] for j in range(n)])
-        # Build constraint with every room in the same row
-        c_row = Constraint("C(R-Row{})".format(i), [var_array[j][i] for j in range(n)])
-        c_col.add_satisfying_tuples(sat_tuples)
-        c_row.add_satisfying_tuples(sat_tuples)
-        cons.append(c_col)
-        cons.append(c_row)
-
-    for i in range(n):
-        build_row_col_constraints(i)
-
-    csp = CSP("Warehouse-{}".format(n), vars)
-    for c in cons:
-        csp.add_constraint(c)
-
-    return csp, var_array
-
-def warehouse_full_model(warehouse_grid):
-    n = warehouse_grid[0][0]
-    domain = list(range(1, n + 1))
-    domain_list = [domain for _ in range(n)]
-    var_array = [[0 for _ in range(n)] for _ in range(n)]
-    vars = []
-    cons = []
-    rc_sat_tuples = []
-
-    # Get sat_tuples for row and col constraints
-    for t in itertools.product(domain, repeat=n):
-        if len(set(t)) == len(t):
-            rc_sat_tuples.append(t)
-
-    def get_builidng_sat_tuples(operation, target_val, rooms):
-        def plus_f(t):
-            return sum(t) == target_val
-        def min_f(t):
-            return min(t) >= target_val
-        def max_f(t):
-            return max(t) <= target_val
-
-        f = None
-        if operation == 0:
-            return [(target_val,)]
-        elif operation == 1:
-            f = plus_f
-        elif operation == 2:
-            f = min_f
-        elif operation == 3:
-            f = max_f
-        else:
-            print("Error: Invalid operation value")
-
-        domain_list = [domain for _ in range(len(rooms))]
-        building_sat_tuples = []
-        for t in itertools.product(domain, repeat=len(rooms)):
-            if f(t):
-                building_sat_tuples.append(t)
-        return building_sat_tuples
-
-    for i in range(1, len(warehouse_grid)):
-        building = warehouse_grid[i]
-        operation = building[len(building) - 2]
-        target_val = building[len(building) - 1]
-        current_building_rooms = []
-        for j in range(len(building) - 2):
-            col = building[j] // 10
-            row = building[j] % 10
-            var = Variable("R{}{}".format(col, row), domain)
-            vars.append(var)
-            current_building_rooms.append(var)
-            var_array[(n + 1 - row) - 1][col - 1] = var
-        c_building = Constraint("C(Building{})".format(i), current_building_rooms)
-        c_building.add_satisfying_tuples(get_builidng_sat_tuples(operation, target_val, current_building_rooms))
-        cons.append(c_building)
-
-    def build_row_col_constraints(i):
-        # Build constraint with every room in the same column
-        c_col = Constraint("C(Col{})".format(i), [var_array[i][j] for j in range(n)])
-        # Build constraint with every room in the same row
-        c_row = Constraint("C(Row{})".format(i), [var_array[j][i] for j in range(n)])
-        c_col.add_satisfying_tuples(rc_sat_tuples)
-        c_row.add_satisfying_tuples(rc_sat_tuples)
-        cons.append(c_col)
-        cons.append(c_row)
-
-    for i in range(n):
-        build_row_col_constraints(i)
-
-    csp = CSP("Warehouse-{}".format(n), vars)
-    for c in cons:
-        csp.add_constraint(c)
-
+#Look for #IMPLEMENT tags in this file.
+'''
+All models need to return a CSP object, and a list of lists of Variable objects 
+representing the board. The returned list of lists is used to access the 
+solution. 
+
+For example, after these three lines of code
+
+    csp, var_array = warehouse_binary_ne_grid(board)
+    solver = BT(csp)
+    solver.bt_search(prop_FC, var_ord)
+
+var_array[0][0].get_assigned_value() should be the correct value in the top left
+cell of the warehouse.
+
+The grid-only models do not need to encode the cage constraints.
+Without them a solution is just a Latin square, and any permutation of
+its rows, of its columns or of its values is a solution too. With
+symmetry_breaking=True, e.g.,
+
+    csp, var_array = warehouse_nary_ad_grid(board, symmetry_breaking=True)
+
+the grid-only models only have the solutions whose first row and first
+column are 1, 2, ..., n (see reduced_domain), so that search does
+not go through every permutation of a solution or of a failed branch.
+
+1. warehouse_binary_ne_grid
+    - A model of the warehouse problem w/o room constraints built using only 
+      binary not-equal constraints for the row/column constraints.
+
+2. warehouse_nary_ad_grid
+    - A model of the warehouse problem w/o room constraints built using only n-ary 
+      all-different constraints for the row/column constraints. 
+
+3. warehouse_full_model
+    - A model of the warehouse problem built using either the binary not-equal or n-ary
+      all-different constraints for the row/column constraints.
+
+Built models can optionally be cached on disk: after
+
+    enable_model_cache("some/dir")
+
+every model built is also saved (see ModelCache) and the next call with
+the same grid loads the saved copy instead of building the model again.
+'''
+from cspbase import *
+import cspbase
+import itertools
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+class ModelCache:
+    '''Directory of compiled models, one file per (model, grid), holding
+       the CSP in the form of CSP.compact plus the layout of var_array.
+
+       A file is MAGIC followed by a pickle. The tables of the models
+       are small (a binary table has at most 9 * 9 tuples), so they are
+       pickled with the rest rather than memory-mapped. When the files
+       take more than max_bytes, the least recently used ones are
+       deleted.
+
+       The file names hash the source of cspbase.py and models.py
+       (see code_version) together with the model and the grid, so a
+       model saved before either file changed is never loaded again;
+       such files are left for evict to delete.'''
+
+    MAGIC = b"WHMODEL2"
+    version = None          #code_version(), computed on first use
+
+    def __init__(self, path, max_bytes=64 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def code_version():
+        '''Hash of the file format and of the source of the modules
+           that build and load models'''
+        if ModelCache.version is None:
+            h = hashlib.sha1(ModelCache.MAGIC)
+            for fname in (cspbase.__file__, __file__):
+                with open(fname, "rb") as f:
+                    h.update(f.read())
+            ModelCache.version = h.hexdigest()
+        return ModelCache.version
+
+    def file_for(self, model, warehouse_grid, options=None):
+        key = [self.code_version(), model, warehouse_grid]
+        if options:
+            key.append(options)
+        key = json.dumps(key, separators=(",", ":"), sort_keys=True)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, "{}-{}.csp".format(model, digest[:20]))
+
+    def load(self, model, warehouse_grid, options=None):
+        '''Return (csp, var_array) for the saved model, None if there is
+           none. options are the keyword arguments of the builder.'''
+        fname = self.file_for(model, warehouse_grid, options)
+        try:
+            with open(fname, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            if data[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError("not a model file")
+            compact, layout = pickle.loads(memoryview(data)[len(self.MAGIC):])
+            csp = CSP.from_compact(compact)
+            os.utime(fname)     #most recently used
+        except Exception:
+            #stale, damaged or just evicted file: build the model again
+            return None
+        var_array = [[csp.vars[i] for i in row] for row in layout]
+        return csp, var_array
+
+    def store(self, model, warehouse_grid, csp, var_array, options=None):
+        '''Save the model, then evict old files if over max_bytes'''
+        index = dict()
+        for i, var in enumerate(csp.vars):
+            index[var] = i
+        layout = [[index[var] for var in row] for row in var_array]
+        data = pickle.dumps((csp.compact(), layout), protocol=pickle.HIGHEST_PROTOCOL)
+        fname = self.file_for(model, warehouse_grid, options)
+        tmp = "{}.{}.tmp".format(fname, os.getpid())
+        try:
+            with open(tmp, "wb") as f:
+                f.write(self.MAGIC)
+                f.write(data)
+            os.replace(tmp, fname)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".csp"):
+                fname = os.path.join(self.path, name)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, fname))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, fname in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total = total - size
+
+MODEL_CACHE = None      #ModelCache used by the model builders, None for no cache
+
+def enable_model_cache(path, max_bytes=64 * 2 ** 20):
+    '''Cache the models built from now on in directory path'''
+    global MODEL_CACHE
+    MODEL_CACHE = ModelCache(path, max_bytes)
+
+def disable_model_cache():
+    global MODEL_CACHE
+    MODEL_CACHE = None
+
+def cached_model(builder):
+    '''Decorator: look the model up in MODEL_CACHE before building it'''
+    signature = inspect.signature(builder)
+
+    @functools.wraps(builder)
+    def build(warehouse_grid, *args, **kwargs):
+        cache = MODEL_CACHE
+        if cache is None:
+            return builder(warehouse_grid, *args, **kwargs)
+        #all the options by name, whether given by position, by name or
+        #left to their default, so that equal calls share one file
+        bound = signature.bind(warehouse_grid, *args, **kwargs)
+        bound.apply_defaults()
+        options = dict(bound.arguments)
+        del options[next(iter(signature.parameters))]
+        model = cache.load(builder.__name__, warehouse_grid, options)
+        if model is None:
+            model = builder(warehouse_grid, *args, **kwargs)
+            cache.store(builder.__name__, warehouse_grid, *model, options)
+        return model
+    return build
+
+def reduced_domain(n, i, j):
+    '''Domain of the room at var_array[i][j] of a grid-only model with
+       symmetry breaking: only the reduced Latin squares, whose first row
+       and first column are both 1, 2, ..., n, are left.
+
+       Every solution has a reduced one in its class: permuting the
+       values makes the first row 1, ..., n (value symmetry), then
+       sorting the rows by their first value makes the first column
+       1, ..., n too (row symmetry; this is the lexicographic ordering
+       of the rows, as their first values all differ). As the ordering
+       leaves no choice once the first row is fixed, the rooms of the
+       first row and column get a domain of one value, which holds for
+       every propagator, prop_BT included, without any constraint.
+
+       Not for warehouse_full_model: the building constraints are not
+       symmetric.'''
+    if i == 0:
+        return [j + 1]
+    if j == 0:
+        return [i + 1]
+    return list(range(1, n + 1))
+
+@cached_model
+def warehouse_binary_ne_grid(warehouse_grid, symmetry_breaking=False):
+    n = warehouse_grid[0][0]
+    domain = list(range(1, n + 1))
+    var_array = [[0 for _ in range(n)] for _ in range(n)]
+    vars = []
+    cons = []
+    sat_tuples = []
+
+    for t in itertools.product(domain, domain):
+        if t[0] != t[1]:
+            sat_tuples.append(t)
+    # Every not-equal constraint shares this one (immutable) table
+    ne_table = TupleTable.intern(TupleTable([domain, domain], sat_tuples))
+
+    for i in range(1, len(warehouse_grid)):
+        building = warehouse_grid[i]
+        operation = building[len(building) - 2]
+        target_val = building[len(building) - 1]
+        for j in range(len(building) - 2):
+            col = building[j] // 10
+            row = building[j] % 10
+            if symmetry_breaking:
+                var = Variable("R{}{}".format(col, row), reduced_domain(n, n - row, col - 1))
+            else:
+                var = Variable("R{}{}".format(col, row), domain)
+            vars.append(var)
+            var_array[(n + 1 - row) - 1][col - 1] = var
+
+    def ne_table_for(x, y):
+        # Rooms with a reduced domain need a table over their own domain
+        if x.domain() == domain and y.domain() == domain:
+            return ne_table
+        return TupleTable.intern(TupleTable([x.domain(), y.domain()], sat_tuples))
+
+    def build_row_col_constraints(i, j):
+        # Build constraint with every room in the same column
+        for k in range(j + 1, n):
+            c = Constraint("C(R{}{},R{}{})".format(i + 1, j + 1, i + 1, k + 1), [var_array[i][j], var_array[i][k]])
+            c.set_table(ne_table_for(var_array[i][j], var_array[i][k]))
+            cons.append(c)
+
+        # Build constraint with every room in the same row
+        for k in range(i + 1, n):
+            c = Constraint("C(R{}{},R{}{})".format(i + 1, j + 1, k + 1, j + 1), [var_array[i][j], var_array[k][j]])
+            c.set_table(ne_table_for(var_array[i][j], var_array[k][j]))
+            cons.append(c)
+
+    for i in range(n):
+        for j in range(n):
+            build_row_col_constraints(i, j)
+
+    csp = CSP("Warehouse-{}".format(n), vars)
+    for c in cons:
+        csp.add_constraint(c)
+
+    return csp, var_array
+
+@cached_model
+def warehouse_nary_ad_grid(warehouse_grid, symmetry_breaking=False):
+    n = warehouse_grid[0][0]
+    domain = list(range(1, n + 1))
+    var_array = [[0 for _ in range(n)] for _ in range(n)]
+    vars = []
+    cons = []
+
+    for i in range(1, len(warehouse_grid)):
+        building = warehouse_grid[i]
+        operation = building[len(building) - 2]
+        target_val = building[len(building) - 1]
+        for j in range(len(building) - 2):
+            col = building[j] // 10
+            row = building[j] % 10
+            if symmetry_breaking:
+                var = Variable("R{}{}".format(col, row), reduced_domain(n, n - row, col - 1))
+            else:
+                var = Variable("R{}{}".format(col, row), domain)
+            vars.append(var)
+            var_array[(n + 1 - row) - 1][col - 1] = var
+
+    def build_row_col_constraints(i):
+        # Build constraint with every room in the same column
+        c_col = AllDifferentConstraint("C(R-Col{})".format(i), [var_array[i][j] for j in range(n)])
+        # Build constraint with every room in the same row
+        c_row = AllDifferentConstraint("C(R-Row{})".format(i), [var_array[j][i] for j in range(n)])
+        cons.append(c_col)
+        cons.append(c_row)
+
+    for i in range(n):
+        build_row_col_constraints(i)
+
+    csp = CSP("Warehouse-{}".format(n), vars)
+    for c in cons:
+        csp.add_constraint(c)
+
+    return csp, var_array
+
+@cached_model
+def warehouse_full_model(warehouse_grid):
+    n = warehouse_grid[0][0]
+    domain = list(range(1, n + 1))
+    var_array = [[0 for _ in range(n)] for _ in range(n)]
+    vars = []
+    cons = []
+
+    def get_building_constraint(name, operation, target_val, rooms):
+        # A single room building (operation 0) is just rooms[0] == target_val
+        if operation == 0 or operation == 1:
+            return SumConstraint(name, rooms, target_val)
+        elif operation == 2:
+            return MinConstraint(name, rooms, target_val)
+        elif operation == 3:
+            return MaxConstraint(name, rooms, target_val)
+        else:
+            print("Error: Invalid operation value")
+
+    for i in range(1, len(warehouse_grid)):
+        building = warehouse_grid[i]
+        operation = building[len(building) - 2]
+        target_val = building[len(building) - 1]
+        current_building_rooms = []
+        for j in range(len(building) - 2):
+            col = building[j] // 10
+            row = building[j] % 10
+            var = Variable("R{}{}".format(col, row), domain)
+            vars.append(var)
+            current_building_rooms.append(var)
+            var_array[(n + 1 - row) - 1][col - 1] = var
+        c_building = get_building_constraint("C(Building{})".format(i), operation, target_val,
+                                             current_building_rooms)
+        cons.append(c_building)
+
+    def build_row_col_constraints(i):
+        # Build constraint with every room in the same column
+        c_col = AllDifferentConstraint("C(Col{})".format(i), [var_array[i][j] for j in range(n)])
+        # Build constraint with every room in the same row
+        c_row = AllDifferentConstraint("C(Row{})".format(i), [var_array[j][i] for j in range(n)])
+        cons.append(c_col)
+        cons.append(c_row)
+
+    for i in range(n):
+        build_row_col_constraints(i)
+
+    csp = CSP("Warehouse-{}".format(n), vars)
+    for c in cons:
+        csp.add_constraint(c)
+
     return csp, var_array
\ No newline at end of file
@@ -0,0 +1,182 @@
+'''Parallel tree search for exhaustive runs: enumerating or counting all
+solutions of a CSP, or proving that it has none.
+
+The search tree of bt_search is split into subproblems, each given by
+a prefix of decisions [(var, val), ...]. Worker processes take
+subproblems from a shared queue and search them with bt_iterate. Every
+few dead ends, and at each solution, a worker checks whether another
+worker is idle, and if so gives away the untried values of its
+shallowest open choice point (BT.split_off) as new subproblems. Any
+idle worker can take these, so work keeps moving from busy workers to
+idle ones until the whole tree has been explored. The parent process
+keeps count of the outstanding subproblems and combines the solutions
+and statistics, e.g.,
+
+    csp, var_array = warehouse_nary_ad_grid(board)
+    count, solns, stats = parallel_solutions(csp, prop_GAC, count_only=True)
+
+As in portfolio.py, the CSP is sent to the workers in the form returned
+by CSP.compact.
+'''
+import multiprocessing
+import os
+import queue
+from cspbase import BT, CSP
+
+#statistics of BT that are added up over all subproblems
+STATS = ["nDecisions", "nPrunings", "nFailures"]
+
+def parallel_solutions(csp, propagator, var_ord=None, val_ord=None,
+                       processes=None, limit=None, count_only=False,
+                       split_every=64):
+    '''Search for all solutions of csp with several worker processes.
+
+       propagator, var_ord and val_ord are as for bt_search.
+       processes == number of workers (default: one per CPU)
+       limit == stop once this many solutions were found (None: all)
+       count_only == True to only count the solutions, not send them
+                     back from the workers
+       split_every == number of dead ends a worker goes through before
+                      looking for idle workers to give work to
+
+       Returns (count, solutions, stats): the number of solutions
+       found, a list of them (each a dict mapping every Variable of csp
+       to its value; None if count_only) and a dict of search
+       statistics added up over the workers, together with the number
+       of subproblems searched (nTasks) and of times work was given
+       away (nSplits). The variables of csp themselves are not changed.
+
+       Raises RuntimeError if a worker dies before the search is over,
+       as the solutions found so far may then be only some of them.'''
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(processes, 1)
+    compact = csp.compact()
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    idle = multiprocessing.Value('i', 0)
+    workers = []
+    for _ in range(processes):
+        p = multiprocessing.Process(target=parallel_worker,
+                                    args=(compact, propagator, var_ord, val_ord,
+                                          split_every, not count_only,
+                                          tasks, results, idle))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+
+    count = 0
+    solns = None if count_only else []
+    stats = dict.fromkeys(STATS + ["nTasks", "nSplits"], 0)
+    tasks.put([])
+    outstanding = 1         #subproblems queued or being searched
+    finished = False
+    died = False
+    try:
+        while outstanding:
+            try:
+                msg = results.get(timeout=0.1)
+            except queue.Empty:
+                if not all(p.is_alive() for p in workers):
+                    died = True
+                    break
+                continue
+            if msg[0] == "split":
+                stats["nSplits"] = stats["nSplits"] + 1
+                for prefix in msg[1]:
+                    tasks.put(prefix)
+                    outstanding = outstanding + 1
+                continue
+
+            _, n, values, task_stats = msg
+            outstanding = outstanding - 1
+            stats["nTasks"] = stats["nTasks"] + 1
+            for key in STATS:
+                stats[key] = stats[key] + task_stats[key]
+            count = count + n
+            if solns is not None:
+                solns.extend(dict(zip(csp.vars, vals)) for vals in values)
+            if limit is not None and count >= limit:
+                break
+        finished = not outstanding
+    finally:
+        if finished:
+            for p in workers:
+                tasks.put(None)
+        else:
+            for p in workers:
+                p.terminate()
+        for p in workers:
+            p.join()
+        for q in (tasks, results):
+            q.close()
+            q.cancel_join_thread()
+
+    if died:
+        raise RuntimeError("a parallel search worker died, the search is incomplete")
+
+    if limit is not None and count > limit:
+        count = limit
+        if solns is not None:
+            del solns[limit:]
+    return count, solns, stats
+
+def parallel_worker(compact, propagator, var_ord, val_ord, split_every, collect,
+                    tasks, results, idle):
+    '''Search the subproblems taken from tasks until a None arrives.
+       For each one put ("done", count, solutions, stats) on results,
+       and ("split", prefixes) whenever work is given away.'''
+    csp = CSP.from_compact(compact)
+    var_index = dict()
+    for i, var in enumerate(csp.vars):
+        var_index[var] = i
+    solver = BT(csp)
+
+    while True:
+        with idle.get_lock():
+            idle.value = idle.value + 1
+        prefix = tasks.get()
+        with idle.get_lock():
+            idle.value = idle.value - 1
+        if prefix is None:
+            return
+
+        count = 0
+        values = []
+        status = solver.bt_start(propagator)
+        for i, val in prefix:
+            var = csp.vars[i]
+            if not status or not var.in_cur_domain(val):
+                status = False
+                break
+            var.assign(val)
+            solver.unasgn_vars.remove(var)
+            solver.nDecisions = solver.nDecisions + 1
+            status, _ = solver.propagate(propagator, var)
+
+        resume = False
+        while status:
+            status = solver.bt_iterate(propagator, var_ord, val_ord, split_every,
+                                       False, resume)
+            resume = True
+            if status:
+                count = count + 1
+                if collect:
+                    values.append([var.get_assigned_value() for var in csp.vars])
+            elif status is None:
+                status = True       #only the cutoff was reached
+            else:
+                break
+            #share work if some worker is waiting
+            if idle.value > 0:
+                split = solver.split_off()
+                if split:
+                    results.put(("split", [prefix + [(var_index[var], val) for var, val in s]
+                                           for s in split]))
+
+        stats = dict()
+        for key in STATS:
+            stats[key] = getattr(solver, key)
+        results.put(("done", count, values, stats))
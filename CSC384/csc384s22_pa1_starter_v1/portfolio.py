@@ -0,0 +1,115 @@
+'''Portfolio solving: race several search configurations on one CSP.
+
+How long bt_search takes on a given instance depends a lot on the
+propagator, the variable ordering and (with restarts) the random seed,
+and no single configuration is best on every instance. portfolio_solve
+runs several configurations at once, one worker process each, returns
+the answer of the first one to finish and stops the others, e.g.,
+
+    csp, var_array = warehouse_full_model(board)
+    status, soln, config = portfolio_solve(csp)
+    if status:
+        print(soln[var_array[0][0]])
+
+A configuration is a tuple
+
+    (propagator, var_ord, val_ord, restarts)
+
+with the meaning these arguments have for bt_search (var_ord, val_ord
+and restarts may be None). The CSP is sent to the workers in the form
+returned by CSP.compact, so FunctionConstraints must use module level
+check functions.
+'''
+import contextlib
+import io
+import multiprocessing
+import os
+import queue
+import time
+from cspbase import BT, CSP, Luby, SOLVED
+from propagators import prop_FC, prop_GAC
+from heuristics import MRV, DomDeg, DomWDeg, val_lcv
+
+#tried in this order; portfolio_solve uses the first 'processes' of them
+DEFAULT_CONFIGS = [
+    (prop_GAC, DomWDeg(), None, Luby()),
+    (prop_FC, DomWDeg(), None, Luby()),
+    (prop_GAC, None, None, None),
+    (prop_GAC, MRV(), val_lcv, Luby()),
+    (prop_FC, MRV(), None, None),
+    (prop_GAC, DomDeg(), None, None),
+    (prop_FC, DomWDeg(), val_lcv, Luby(8)),
+    (prop_GAC, DomWDeg(), None, Luby(128)),
+]
+
+def portfolio_solve(csp, configs=None, processes=None, seed=0, timeout=None):
+    '''Solve csp with several configurations in parallel.
+
+       configs == list of configurations (default DEFAULT_CONFIGS)
+       processes == how many configurations to run (default: one per
+                    CPU, at most len(configs))
+       seed == worker i searches with random seed seed + i
+       timeout == seconds to wait for an answer (None: no limit)
+
+       Returns (status, solution, config): status is True if a solution
+       was found, False if the CSP has no solution and None if no worker
+       answered in time. solution maps each Variable of csp to its value
+       (None unless status is True) and config is the configuration that
+       answered first. The variables of csp themselves are not changed.'''
+
+    if configs is None:
+        configs = DEFAULT_CONFIGS
+    if processes is None:
+        processes = os.cpu_count() or 1
+    configs = configs[:max(processes, 1)]
+    compact = csp.compact()
+
+    results = multiprocessing.Queue()
+    workers = []
+    for i, config in enumerate(configs):
+        p = multiprocessing.Process(target=portfolio_worker,
+                                    args=(compact, config, seed + i, i, results))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+
+    answer = None
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        while answer is None:
+            wait = 0.1 if deadline is None else min(0.1, deadline - time.time())
+            if wait <= 0:
+                break
+            try:
+                answer = results.get(timeout=wait)
+            except queue.Empty:
+                if not any(p.is_alive() for p in workers) and results.empty():
+                    #every worker died without answering
+                    break
+    finally:
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+        for p in workers:
+            p.join()
+        results.close()
+        results.cancel_join_thread()
+
+    if answer is None:
+        return None, None, None
+    i, status, values = answer
+    solution = None
+    if status:
+        solution = dict(zip(csp.vars, values))
+    return status, solution, configs[i]
+
+def portfolio_worker(compact, config, seed, i, results):
+    '''Run one configuration and put (i, status, values) on results'''
+    propagator, var_ord, val_ord, restarts = config
+    csp = CSP.from_compact(compact)
+    solver = BT(csp)
+    with contextlib.redirect_stdout(io.StringIO()):
+        status, _, soln = solver.bt_search(propagator, var_ord, val_ord, restarts, seed)
+    status = status == SOLVED
+    values = [soln[v] for v in csp.vars] if status else None
+    results.put((i, status, values))
@@ -51,18 +51,27 @@ In summary, this is what the propagator must do:
 
          for gac;
             we initialize the GAC queue with all constraints containing V
+
+Each time a propagator revises a constraint c it adds one to
+c.revisions, and it adds the number of values (prop_FC, prop_GAC) or
+tuples (prop_BT) it checks to c.checks. BT.get_stats reports these to
+show which constraints the propagation time goes to.
    '''
+from cspbase import ConstraintQueue
 
 def prop_BT(csp, newVar=None):
     if not newVar:
         return True, []
     for c in csp.get_cons_with_var(newVar):
         if c.get_n_unasgn() == 0:
+            c.revisions = c.revisions + 1
+            c.checks = c.checks + 1
             vals = []
             vars = c.get_scope()
             for var in vars:
                 vals.append(var.get_assigned_value())
             if not c.check(vals):
+                c.bump_weight()
                 return False, []
     return True, []
 
@@ -70,33 +79,46 @@ def prop_FC(csp, newVar=None):
     cons = csp.get_cons_with_var(newVar) if newVar else csp.get_all_cons()
     prunings = []
     for c in cons:
-        if c.get_n_unasgn() == 1:
-            var = c.get_unasgn_vars()[0]
-            for val in var.cur_domain():
+        var = c.get_last_unasgn_var()
+        if var is not None:
+            dom = var.cur_domain()
+            c.revisions = c.revisions + 1
+            c.checks = c.checks + len(dom)
+            for val in dom:
                 if not c.has_support(var, val):
                     var.prune_value(val)
                     prunings.append((var, val))
                     if var.cur_domain_size() == 0:
+                        c.bump_weight()
                         return False, prunings
     return True, prunings
 
 def prop_GAC(csp, newVar=None):
     cons = csp.get_cons_with_var(newVar) if newVar else csp.get_all_cons()
-    c_queue = []
-    for c in cons:
-        c_queue.append(c)
+    c_queue = ConstraintQueue(cons)
     prunings = []
 
     while c_queue:
-        c = c_queue.pop(0)
-        for var in c.get_unasgn_vars():
-            for val in var.cur_domain():
-                if not c.has_support(var, val):
-                    var.prune_value(val)
-                    prunings.append((var, val))
-                    if var.cur_domain_size() == 0:
-                        return False, prunings
-                    else:
-                        for new_c in csp.get_cons_with_var(var):
-                            c_queue.append(new_c)
+        c = c_queue.pop()
+        # c is not queued again for its own prunings, so revise it
+        # until a whole pass over its scope prunes nothing
+        changed = True
+        while changed:
+            changed = False
+            c.revisions = c.revisions + 1
+            for var in c.get_unasgn_vars():
+                dom = var.cur_domain()
+                c.checks = c.checks + len(dom)
+                for val in dom:
+                    if not c.has_support(var, val):
+                        var.prune_value(val)
+                        prunings.append((var, val))
+                        changed = True
+                        if var.cur_domain_size() == 0:
+                            c.bump_weight()
+                            return False, prunings
+                        else:
+                            for new_c in csp.get_cons_with_var(var):
+                                if new_c is not c:
+                                    c_queue.push(new_c)
     return True, prunings
\ No newline at end of file
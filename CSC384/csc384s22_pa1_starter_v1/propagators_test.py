@@ -1,6 +1,16 @@
 from cspbase import *
 from propagators import *
+from models import warehouse_binary_ne_grid, warehouse_nary_ad_grid, warehouse_full_model
+from models import ModelCache, enable_model_cache, disable_model_cache
+from parallel import parallel_solutions
+from heuristics import MRV
+import contextlib
+import io
 import itertools
+import os
+import random
+import shutil
+import tempfile
 
 # simple CSP
 
@@ -64,8 +74,8 @@ def queensCheck(qi, qj, i, j):
     '''
     return i != j and abs(i-j) != abs(qi-qj)
 
-def nQueens(n):
-    '''Return an n-queens CSP'''
+def nQueens(n, cls=Constraint):
+    '''Return an n-queens CSP, with table constraints of class cls'''
     i = 0
     dom = []
     for i in range(n):
@@ -78,7 +88,7 @@ def nQueens(n):
     cons = []    
     for qi in range(len(dom)):
         for qj in range(qi+1, len(dom)):
-            con = Constraint("C(Q{},Q{})".format(qi+1, qj+1), [vars[qi], vars[qj]])
+            con = cls("C(Q{},Q{})".format(qi+1, qj+1), [vars[qi], vars[qj]])
             sat_tuples = []
             for t in itertools.product(dom, dom):
                 if queensCheck(qi, qj, t[0], t[1]):
@@ -91,6 +101,347 @@ def nQueens(n):
         csp.add_constraint(c)
     return csp
 
+#random CSPs, checked against brute force enumeration
+
+def random_csp(seed, nvars=5, domsize=3, ncons=6, arity=2, density=0.6):
+    '''Return a random CSP of nvars variables, each with a random
+       domain of at most domsize values, and ncons table constraints of
+       the given arity, each allowing about density of all tuples'''
+    rng = random.Random(seed)
+    vars = []
+    for i in range(nvars):
+        dom = rng.sample(range(domsize + 1), rng.randint(1, domsize))
+        vars.append(Variable('V{}'.format(i), dom))
+    csp = CSP("Random-{}".format(seed), vars)
+    for k in range(ncons):
+        scope = rng.sample(vars, arity)
+        c = Constraint("C{}".format(k), scope)
+        c.add_satisfying_tuples([t for t in itertools.product(*[v.domain() for v in scope])
+                                 if rng.random() < density])
+        csp.add_constraint(c)
+    return csp
+
+def brute_force_solutions(csp):
+    '''Return the set of solutions of csp, each a tuple of the values of
+       csp.vars, by trying every assignment'''
+    solns = set()
+    for vals in itertools.product(*[v.domain() for v in csp.vars]):
+        value = dict(zip(csp.vars, vals))
+        if all(c.check([value[v] for v in c.get_scope()]) for c in csp.get_all_cons()):
+            solns.add(vals)
+    return solns
+
+def bt_solution_set(csp, propagator, **kwargs):
+    '''Return the set of solutions bt_solutions finds (failing if it
+       finds one twice or prints anything)'''
+    out = io.StringIO()
+    solns = []
+    with contextlib.redirect_stdout(out):
+        for soln in BT(csp).bt_solutions(propagator, **kwargs):
+            solns.append(tuple(soln[v] for v in csp.vars))
+    assert out.getvalue() == "", out.getvalue()
+    assert len(solns) == len(set(solns)), "solution found twice"
+    return set(solns)
+
+def check_sac():
+    '''Singleton arc consistency must neither lose solutions nor try a
+       value that was pruned while it went through a variable'''
+    for seed in range(300):
+        csp = random_csp(seed, nvars=6, domsize=4, ncons=8, arity=3, density=0.4)
+        expected = brute_force_solutions(csp)
+        for prop in (prop_BT, prop_FC, prop_GAC):
+            assert bt_solution_set(csp, prop, sac=prop_GAC) == expected, (seed, prop)
+    print("Singleton arc consistency: OK")
+
+def check_backjump():
+    '''Conflict-directed backjumping must find exactly the solutions
+       plain backtracking finds'''
+    for seed in range(300):
+        csp = random_csp(seed, nvars=7, domsize=3, ncons=10, arity=2, density=0.6)
+        expected = brute_force_solutions(csp)
+        for prop in (prop_BT, prop_FC):
+            assert bt_solution_set(csp, prop, backjump=True) == expected, (seed, prop)
+        csp = random_csp(seed, nvars=6, domsize=3, ncons=5, arity=3, density=0.5)
+        expected = brute_force_solutions(csp)
+        for prop in (prop_BT, prop_FC):
+            assert bt_solution_set(csp, prop, backjump=True) == expected, (seed, prop)
+    print("Backjumping: OK")
+
+def check_restarts():
+    '''Restarting after every dead end (Luby(1)) with nogoods recorded
+       must still find a solution exactly when there is one'''
+    for seed in range(300):
+        csp = random_csp(seed, nvars=7, domsize=3, ncons=10, arity=2, density=0.6)
+        expected = brute_force_solutions(csp)
+        for prop in (prop_BT, prop_FC, prop_GAC):
+            for backjump in (False, True):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    status, _, soln = BT(csp).bt_search(prop, restarts=Luby(1), seed=seed,
+                                                        backjump=backjump)
+                if expected:
+                    assert status == SOLVED, (seed, prop)
+                    assert tuple(soln[v] for v in csp.vars) in expected, (seed, prop)
+                else:
+                    assert status == UNSAT, (seed, prop)
+    print("Restarts with nogoods: OK")
+
+def gac_domains(csp, assignment):
+    '''Assign the (var, val) pairs of assignment, one at a time, each
+       followed by prop_GAC. Return False if prop_GAC fails, otherwise
+       the current domains of the variables. Undo everything before
+       returning.'''
+    result = None
+    status, _ = prop_GAC(csp)
+    for var, val in assignment:
+        if not status or not var.in_cur_domain(val):
+            break
+        var.assign(val)
+        status, _ = prop_GAC(csp, var)
+    else:
+        if status:
+            result = [v.cur_domain() for v in csp.vars]
+    for v in csp.vars:
+        if v.is_assigned():
+            v.unassign()
+        v.restore_curdom()
+    return result if status else False
+
+def check_alldiff():
+    '''AllDifferentConstraint must prune exactly what GAC on the table
+       of all-different tuples prunes'''
+    for seed in range(300):
+        rng = random.Random(seed)
+        vars = [Variable('V{}'.format(i), rng.sample(range(5), rng.randint(1, 4)))
+                for i in range(6)]
+        scopes = [rng.sample(vars, rng.randint(2, 5)) for _ in range(3)]
+        models = []
+        for cls in (AllDifferentConstraint, Constraint):
+            csp = CSP("AllDiff-{}".format(seed), vars)
+            for k, scope in enumerate(scopes):
+                c = cls("AD{}".format(k), scope)
+                if cls is Constraint:
+                    c.add_satisfying_tuples([t for t in itertools.product(*[v.domain() for v in scope])
+                                             if len(set(t)) == len(t)])
+                csp.add_constraint(c)
+            models.append(csp)
+        order = rng.sample(vars, len(vars))
+        for k in range(len(vars)):
+            assignment = [(v, rng.choice(v.domain())) for v in order[:k]]
+            assert gac_domains(models[0], assignment) == gac_domains(models[1], assignment), (seed, k)
+        expected = brute_force_solutions(models[1])
+        for prop in (prop_FC, prop_GAC):
+            assert bt_solution_set(models[0], prop) == expected, (seed, prop)
+    print("All-different: OK")
+
+def check_arithmetic():
+    '''SumConstraint, MinConstraint and MaxConstraint must prune exactly
+       what GAC on the tables of the warehouse building constraints
+       (sum == target, min >= target, max <= target) prunes'''
+    tests = [(SumConstraint, lambda t, target: sum(t) == target),
+             (MinConstraint, lambda t, target: min(t) >= target),
+             (MaxConstraint, lambda t, target: max(t) <= target)]
+    for seed in range(300):
+        rng = random.Random(seed)
+        vars = [Variable('V{}'.format(i), sorted(rng.sample(range(1, 7), rng.randint(1, 5))))
+                for i in range(5)]
+        cons = []
+        for k in range(3):
+            scope = rng.sample(vars, rng.randint(1, 4))
+            cls, f = rng.choice(tests)
+            if cls is SumConstraint:
+                target = rng.randint(len(scope), 5 * len(scope))
+            else:
+                target = rng.randint(1, 6)
+            cons.append((cls, f, scope, target))
+        models = []
+        for table in (False, True):
+            csp = CSP("Arith-{}".format(seed), vars)
+            for k, (cls, f, scope, target) in enumerate(cons):
+                if table:
+                    c = Constraint("B{}".format(k), scope)
+                    c.add_satisfying_tuples([t for t in itertools.product(*[v.domain() for v in scope])
+                                             if f(t, target)])
+                else:
+                    c = cls("B{}".format(k), scope, target)
+                csp.add_constraint(c)
+            models.append(csp)
+        order = rng.sample(vars, len(vars))
+        for k in range(len(vars)):
+            assignment = [(v, rng.choice(v.domain())) for v in order[:k]]
+            assert gac_domains(models[0], assignment) == gac_domains(models[1], assignment), (seed, k)
+        expected = brute_force_solutions(models[1])
+        for prop in (prop_BT, prop_FC, prop_GAC):
+            assert bt_solution_set(models[0], prop) == expected, (seed, prop)
+    print("Sum/Min/Max: OK")
+
+def check_ct_prunings():
+    '''Compact-Table constraints prune the same values as plain tables,
+       and only values are counted as prunings'''
+    for n in (6, 8, 10):
+        for prop in (prop_FC, prop_GAC):
+            counts = []
+            for cls in (Constraint, CompactTableConstraint):
+                csp = nQueens(n, cls)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    _, stats, _ = BT(csp).bt_search(prop)
+                counts.append((stats["nodes"], stats["prunings"]))
+            assert counts[0] == counts[1], (n, prop, counts)
+    print("Compact-Table prunings: OK")
+
+#grid-only warehouse models
+
+def grid_board(n):
+    '''Return a warehouse board of size n with a one room building per cell'''
+    return [[n]] + [[col * 10 + row, 0, 1] for col in range(1, n + 1) for row in range(1, n + 1)]
+
+def reduced_latin_squares(n):
+    '''Return the set of n x n Latin squares (as tuples of rows) whose
+       first row and first column are 1, 2, ..., n'''
+    perms = list(itertools.permutations(range(1, n + 1)))
+    squares = [[tuple(range(1, n + 1))]]
+    for i in range(1, n):
+        squares = [rows + [p] for rows in squares for p in perms
+                   if p[0] == i + 1 and all(p[j] != r[j] for r in rows for j in range(n))]
+    return set(tuple(rows) for rows in squares)
+
+def reduce_latin_square(square):
+    '''Return the reduced Latin square equivalent to square: values
+       renamed so that the first row is 1, ..., n, then rows reordered
+       so that the first column is too'''
+    rename = dict((val, j + 1) for j, val in enumerate(square[0]))
+    rows = [tuple(rename[val] for val in row) for row in square]
+    return tuple(sorted(rows))
+
+def grid_solutions(model, n, propagator, **kwargs):
+    '''Return the set of solutions (as tuples of rows) of the grid-only
+       model of size n.
+
+       The rooms are assigned the rest of row 1, then the rest of
+       column 1, then the rest of row 2, and so on, so that each row
+       and column is complete, and its constraint checked, as early as
+       possible: in the order of the board, prop_BT and prop_FC take
+       minutes on the n-ary model of size 5.'''
+    csp, var_array = model(grid_board(n), **kwargs)
+    cells = sorted(itertools.product(range(n), repeat=2),
+                   key=lambda ij: (min(ij), ij[0] != min(ij), max(ij)))
+    order = [var_array[i][j] for i, j in cells]
+
+    def band_order(csp):
+        for var in order:
+            if not var.is_assigned():
+                return var
+
+    solns = []
+    for soln in BT(csp).bt_solutions(propagator, var_ord=band_order):
+        solns.append(tuple(tuple(soln[var] for var in row) for row in var_array))
+    assert len(solns) == len(set(solns)), "solution found twice"
+    return set(solns)
+
+def check_symmetry_breaking():
+    '''With symmetry_breaking=True the grid-only models must have
+       exactly the reduced Latin squares as solutions, so that every
+       Latin square (every solution without symmetry breaking) still
+       has its representative among them'''
+    for n, count in ((3, 1), (4, 4), (5, 56)):
+        expected = reduced_latin_squares(n)
+        assert len(expected) == count
+        for model in (warehouse_binary_ne_grid, warehouse_nary_ad_grid):
+            for prop in (prop_BT, prop_FC, prop_GAC):
+                assert grid_solutions(model, n, prop, symmetry_breaking=True) == expected, \
+                    (n, model.__name__, prop.__name__)
+            if n <= 4:
+                squares = grid_solutions(model, n, prop_GAC)
+                assert set(reduce_latin_square(s) for s in squares) == expected, (n, model.__name__)
+    print("Symmetry breaking: OK")
+
+def solve_grid(csp, var_array):
+    '''Return the status of bt_search with prop_GAC on csp and the
+       values of var_array it found'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        status, _, soln = BT(csp).bt_search(prop_GAC)
+    return status, [[soln.get(var) for var in row] for row in var_array]
+
+def check_model_cache():
+    '''A cached model must load as the model that was built, a damaged
+       file must be built again, and the least recently used files must
+       go once the cache is over its size'''
+    board = [[3], [11, 12, 2, 2], [21, 31, 32, 1, 6], [13, 33, 22, 23, 1, 7]]
+    models = [(warehouse_binary_ne_grid, {"symmetry_breaking": False}),
+              (warehouse_nary_ad_grid, {"symmetry_breaking": False}),
+              (warehouse_full_model, {})]
+    path = tempfile.mkdtemp()
+    cache = ModelCache(path)
+    files = dict([(model, cache.file_for(model.__name__, board, options))
+                  for model, options in models])
+    try:
+        enable_model_cache(path)
+        for model, options in models:
+            built = model(board)
+            assert os.path.exists(files[model]), model.__name__
+            loaded = model(board)
+            assert loaded[0] is not built[0]
+            assert len(loaded[0].get_all_cons()) == len(built[0].get_all_cons())
+            assert solve_grid(*loaded) == solve_grid(*built), model.__name__
+        #the same call with the defaults given shares the file
+        warehouse_binary_ne_grid(board, False)
+        warehouse_binary_ne_grid(board, symmetry_breaking=False)
+        assert len(os.listdir(path)) == len(models)
+
+        fname = files[warehouse_full_model]
+        with open(fname, "rb") as f:
+            data = f.read()
+        for damaged in (b"", b"garbage", data[:len(data) // 2]):
+            with open(fname, "wb") as f:
+                f.write(damaged)
+            assert cache.load("warehouse_full_model", board, {}) is None
+            status, _ = solve_grid(*warehouse_full_model(board))
+            assert status == SOLVED
+            #built again and saved over the damaged file
+            assert cache.load("warehouse_full_model", board, {}) is not None
+
+        #least recently used first: nary, binary, full
+        for when, model in enumerate([warehouse_nary_ad_grid, warehouse_binary_ne_grid,
+                                      warehouse_full_model]):
+            os.utime(files[model], (1000 * when, 1000 * when))
+        sizes = dict([(model, os.path.getsize(fname)) for model, fname in files.items()])
+        small = ModelCache(path, sizes[warehouse_binary_ne_grid] + sizes[warehouse_full_model])
+        small.evict()
+        assert sorted(os.listdir(path)) == sorted(
+            os.path.basename(files[model]) for model in (warehouse_binary_ne_grid, warehouse_full_model))
+        #loading makes a file the most recently used one
+        assert small.load("warehouse_binary_ne_grid", board, {"symmetry_breaking": False}) is not None
+        small.max_bytes = sizes[warehouse_binary_ne_grid]
+        small.evict()
+        assert os.listdir(path) == [os.path.basename(files[warehouse_binary_ne_grid])]
+    finally:
+        disable_model_cache()
+        shutil.rmtree(path)
+    print("Model cache: OK")
+
+def check_parallel():
+    '''parallel_solutions must find the solutions bt_solutions finds,
+       each once, with one worker or several, with or without a
+       variable ordering, and stop at the limit (3 solutions)'''
+    problems = [(nQueens(8), prop_FC), (nQueens(6), prop_GAC),
+                (warehouse_nary_ad_grid(grid_board(4))[0], prop_GAC)]
+    for csp, prop in problems:
+        expected = bt_solution_set(csp, prop)
+        for processes in (1, 3):
+            for var_ord in (None, MRV()):
+                count, solns, _ = parallel_solutions(csp, prop, var_ord=var_ord,
+                                                     processes=processes, split_every=4)
+                found = [tuple(soln[v] for v in csp.vars) for soln in solns]
+                assert count == len(found) == len(expected), (csp.name, processes, count)
+                assert set(found) == expected, (csp.name, processes)
+                count, solns, _ = parallel_solutions(csp, prop, var_ord=var_ord,
+                                                     processes=processes, limit=3)
+                found = [tuple(soln[v] for v in csp.vars) for soln in solns]
+                assert count == len(found) == 3, (csp.name, processes, count)
+                assert len(set(found)) == 3 and set(found) <= expected, (csp.name, processes)
+        count, solns, _ = parallel_solutions(csp, prop, processes=3, count_only=True)
+        assert count == len(expected) and solns is None, (csp.name, count)
+    print("Parallel search: OK")
+
 def solve_nQueens(n, propType, trace=False):
     csp = nQueens(n)
     solver = BT(csp)
@@ -103,6 +454,19 @@ def solve_nQueens(n, propType, trace=False):
     elif propType == 'GAC':
         solver.bt_search(prop_GAC)
         
+if __name__ == "__main__":
+    #the parallel workers may import this file (on platforms where
+    #multiprocessing spawns them), so the checks only run from here
+    check_sac()
+    check_ct_prunings()
+    check_backjump()
+    check_restarts()
+    check_alldiff()
+    check_arithmetic()
+    check_symmetry_breaking()
+    check_model_cache()
+    check_parallel()
+
 # trace = True
 trace = False
 # print("Back-Tracking w/o Constraint Propagation on 8-queens")